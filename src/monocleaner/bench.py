@@ -0,0 +1,291 @@
+import argparse
+import statistics
+import subprocess
+import platform
+import logging
+import random
+import json
+import sys
+import os
+from tempfile import TemporaryDirectory
+from timeit import default_timer
+
+try:
+    from . import __version__
+    from .util import logging_setup, check_positive, check_if_folder, open_file
+    from .lm import LOAD_METHODS
+except (SystemError, ImportError):
+    from monocleaner import __version__
+    from util import logging_setup, check_positive, check_if_folder, open_file
+    from lm import LOAD_METHODS
+
+# Modules whose import time is measured, the ones loaded by each command
+STARTUP_MODULES = ["monocleaner.monocleaner", "monocleaner.hardrules", "monocleaner.lm"]
+
+IMPORT_TIMER = "from timeit import default_timer; t = default_timer(); import {}; print(default_timer() - t)"
+
+# Load a model in a new interpreter with a load method and score the tokenized corpus.
+# Arguments are the model, the load method and the tokenized corpus file.
+# Memory is the resident set size in MiB, the peak one where /proc is not available
+LOAD_TIMER = """
+from timeit import default_timer
+import resource, json, sys
+import kenlm
+def rss():
+    try:
+        with open("/proc/self/status") as status:
+            return next(int(l.split()[1]) for l in status if l.startswith("VmRSS:")) / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+with open(sys.argv[3]) as toklines_f:
+    toklines = toklines_f.read().splitlines()
+config = kenlm.Config()
+config.load_method = getattr(kenlm.LoadMethod, sys.argv[2].upper())
+rss_start = rss()
+t = default_timer()
+lm = kenlm.LanguageModel(sys.argv[1], config)
+load_time = default_timer() - t
+rss_load = rss()
+t = default_timer()
+for line in toklines:
+    lm.score(line)
+score_time = default_timer() - t
+print(json.dumps({"load": load_time, "score": score_time, "rss_load": rss_load - rss_start, "rss_score": rss() - rss_start}))
+"""
+
+# Models trained to compare data structures and quantization: name, structure and quantization bits
+MODEL_VARIANTS = [("probing", "probing", 0), ("trie", "trie", 0), ("trie_q8", "trie", 8)]
+
+# Words of the synthetic corpus and the kinds of noise added to some of its sentences
+SYNTHETIC_WORDS = ("the of and to in is was for on that with as by at from this which are be it an have "
+                   "has not but or were their they new one all been first also its more other than "
+                   "time people year city government world school house water market music language "
+                   "between during under after before because through while about against").split()
+SYNTHETIC_NOISE = ["clean", "clean", "clean", "clean", "clean", "shuffled", "url", "numbers", "title",
+                   "repeated", "breadcrumbs", "short", "empty"]
+
+def initialization():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output", type=argparse.FileType('w'), nargs='?', default=sys.stdout, help="Output JSON file with the benchmark results. When omitted it will be written to stdout.")
+    parser.add_argument("--corpus", type=str, help="Corpus used to time each stage, one sentence per line. When omitted a synthetic corpus is generated.")
+    parser.add_argument("--lines", default=10000, type=check_positive, help="Number of sentences of the synthetic corpus")
+    parser.add_argument("--seed", default=1, type=int, help="Random seed of the synthetic corpus")
+    parser.add_argument("-l", "--language", default="en", type=str, help="Language of the corpus and the model")
+    parser.add_argument("--model_dir", type=check_if_folder, help="Model used for scoring. When omitted a small CHARACTER model is trained with KenLM on the corpus.")
+    parser.add_argument("--load_methods", nargs='+', default=list(LOAD_METHODS), choices=list(LOAD_METHODS), help="Model load methods whose load time, memory and scoring speed are measured")
+    parser.add_argument("--repeat", default=5, type=check_positive, help="Number of times each measure is repeated")
+    parser.add_argument("--debug", action='store_true')
+    parser.add_argument("-q", "--quiet", action='store_true')
+
+    args = parser.parse_args()
+    logging_setup(args)
+    logging.debug(args)
+    return args
+
+def synthetic_corpus(lines, seed):
+    ''' Reproducible corpus of clean sentences mixed with the noise hardrules look for '''
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(lines):
+        words = rnd.choices(SYNTHETIC_WORDS, k=rnd.randint(5, 25))
+        words[0] = words[0].capitalize()
+        noise = rnd.choice(SYNTHETIC_NOISE)
+        if noise == "shuffled":
+            words = ["".join(rnd.sample(w, len(w))) for w in words]
+        elif noise == "url":
+            words.append(f"https://www.example{rnd.randint(0, 99)}.com/{rnd.choice(SYNTHETIC_WORDS)}")
+        elif noise == "numbers":
+            words = [str(rnd.randint(0, 10**6)) for _ in words]
+        elif noise == "title":
+            words = [w.title() for w in words]
+        elif noise == "repeated":
+            words += words[-3:]
+        elif noise == "breadcrumbs":
+            words = " > ".join(words).split(" ")
+        elif noise == "short":
+            words = words[:2]
+        elif noise == "empty":
+            words = []
+        corpus.append(" ".join(words) + ("." if words else ""))
+    return corpus
+
+def train_model(corpus, language, model_dir, structure="probing", quantize_bits=0):
+    ''' Train a small CHARACTER model on the corpus, as monocleaner-train does '''
+    try:
+        from .lm import LMFluencyFilter, LMType, shuffle_lm_training, shuffle_chars
+        from .monocleaner_train import write_metadata
+    except (SystemError, ImportError):
+        from lm import LMFluencyFilter, LMType, shuffle_lm_training, shuffle_chars
+        from monocleaner_train import write_metadata
+
+    corpus_path = os.path.join(model_dir, "corpus")
+    with open(corpus_path, "w") as corpus_f:
+        corpus_f.writelines(sentence + "\n" for sentence in corpus)
+    with open(corpus_path) as corpus_f:
+        train_file, dev_file = shuffle_lm_training(corpus_f, max(len(corpus) // 10, 1))
+    dev_noisy = shuffle_chars(dev_file)
+
+    try:
+        options = argparse.Namespace(model_dir=model_dir, language=language, lm_file_name="lm." + language,
+                                     lm_type=LMType.CHARACTER, tokenizer_command=None,
+                                     lm_structure=structure, quantize_bits=quantize_bits, load_method=None)
+        ff = LMFluencyFilter(options.lm_type, language, options.tokenizer_command)
+        stats = ff.train(train_file, dev_file, dev_noisy, os.path.join(model_dir, options.lm_file_name),
+                         structure=structure, quantize_bits=quantize_bits)
+        write_metadata(stats, options)
+    finally:
+        os.remove(train_file)
+        os.remove(dev_file)
+        os.remove(dev_noisy)
+
+def bench_startup(repeat):
+    ''' Time the import of each module in a new interpreter, in seconds '''
+    results = {}
+    for module in STARTUP_MODULES:
+        times = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, "-c", IMPORT_TIMER.format(module)],
+                                    capture_output=True, check=True, text=True)
+            times.append(float(output.stdout))
+        results[module] = {"min": min(times), "median": statistics.median(times)}
+        logging.info(f"Import {module}: {results[module]['median']:.3f} s")
+    return results
+
+def bench_stage(name, func, lines, repeat, setup=None):
+    '''
+    Time func over the corpus repeat times, in seconds. setup is run
+    before each repetition and its result is passed to func.
+    '''
+    times = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        time_start = default_timer()
+        func(state)
+        times.append(default_timer() - time_start)
+    result = {"min": min(times), "median": statistics.median(times), "lines_per_second": lines / max(min(times), 1e-9)}
+    logging.info(f"{name}: {result['median']:.3f} s ({int(result['lines_per_second'])} rows/s)")
+    return result
+
+def bench_stages(args, scoring_args, corpus):
+    ''' Time each scoring stage separately on the corpus '''
+    try:
+        from . import monocleaner
+    except (SystemError, ImportError):
+        import monocleaner
+
+    ff = scoring_args.ff
+    hardrules = monocleaner.create_pipeline(scoring_args).hardrules
+    lowercased = [sentence.lower() for sentence in corpus]
+    toklines = ff._tokenize_batch(corpus)
+    results = monocleaner.create_pipeline(scoring_args).process(corpus)
+    lines = len(corpus)
+    repeat = args.repeat
+
+    stages = {}
+    stages["normalize"] = bench_stage("normalize", lambda _: [ff.normalizer.normalize(s) for s in corpus], lines, repeat)
+    # Character statistics shared by the hardrules, counted once per block
+    stages["char_stats"] = bench_stage("char_stats", lambda _: hardrules.analyze(corpus), lines, repeat)
+    stages["hardrules"] = {}
+    for name, rule in hardrules.rules.items():
+        stages["hardrules"][name[2:]] = bench_stage(f"hardrules {name[2:]}", lambda _: [rule(s) for s in corpus], lines, repeat)
+    # Language identification without the memoization of repeated sentences
+    stages["langid"] = bench_stage("langid", lambda _: [hardrules._identify_language(s) for s in lowercased], lines, repeat)
+    stages["tokenize"] = bench_stage("tokenize", lambda _: ff._tokenize_batch(corpus), lines, repeat)
+    stages["kenlm"] = bench_stage("kenlm", lambda _: [ff.lm.score(t) for t in toklines], lines, repeat)
+    # Same scores, stopping long sentences once they are certain to get score 0
+    counts = [len(t.split()) for t in toklines]
+    stages["kenlm_early_exit"] = bench_stage("kenlm_early_exit", lambda _: ff._kenlm_scores(toklines, counts, ff.scoring_stats.score_floor()), lines, repeat)
+    # Low-order model of the cascade, the fluency stage scores with the cascade when there is one
+    if ff.cascade_lm is not None:
+        stages["kenlm_cascade"] = bench_stage("kenlm_cascade", lambda _: [ff.cascade_lm.score(t) for t in toklines], lines, repeat)
+    stages["fluency"] = bench_stage("fluency", lambda _: ff.score_batch(corpus), lines, repeat)
+    stages["format"] = bench_stage("format", lambda _: [monocleaner.format_output(scoring_args, s, *r) for s, r in zip(corpus, results)], lines, repeat)
+    # Whole pipeline, a new one each time so that nothing is memoized
+    stages["pipeline"] = bench_stage("pipeline", lambda pipeline: pipeline.process(corpus), lines, repeat,
+                                     setup=lambda: monocleaner.create_pipeline(scoring_args))
+    return stages
+
+def bench_loading(models, load_methods, toklines, repeat):
+    '''
+    Load time, peak memory and scoring speed of each model with each load method,
+    each measure in a new interpreter. Memory is in MiB over the interpreter after importing kenlm.
+    '''
+    with TemporaryDirectory() as tmp_dir:
+        toklines_path = os.path.join(tmp_dir, "toklines")
+        with open(toklines_path, "w") as toklines_f:
+            toklines_f.writelines(line + "\n" for line in toklines)
+
+        results = {}
+        for name, lm_path in models.items():
+            results[name] = {"model_mb": os.path.getsize(lm_path) / 2**20}
+            for method in load_methods:
+                runs = []
+                for _ in range(repeat):
+                    output = subprocess.run([sys.executable, "-c", LOAD_TIMER, lm_path, method, toklines_path],
+                                            capture_output=True, check=True, text=True)
+                    runs.append(json.loads(output.stdout))
+                load_times = [run["load"] for run in runs]
+                results[name][method] = {
+                    "load_min": min(load_times),
+                    "load_median": statistics.median(load_times),
+                    "rss_load_mb": statistics.median(run["rss_load"] for run in runs),
+                    "rss_score_mb": statistics.median(run["rss_score"] for run in runs),
+                    "lines_per_second": len(toklines) / max(min(run["score"] for run in runs), 1e-9),
+                }
+                result = results[name][method]
+                logging.info(f"Load {name} {method}: {result['load_median']:.3f} s, {result['rss_score_mb']:.1f} MiB, "
+                             f"{int(result['lines_per_second'])} rows/s")
+    return results
+
+def perform_benchmark(args):
+    if args.corpus:
+        with open_file(args.corpus) as corpus_f:
+            corpus = [line.rstrip("\n") for line in corpus_f]
+    else:
+        corpus = synthetic_corpus(args.lines, args.seed)
+
+    results = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "corpus": {"source": args.corpus or "synthetic", "lines": len(corpus), "seed": None if args.corpus else args.seed},
+        "repeat": args.repeat,
+        "startup": bench_startup(args.repeat),
+    }
+
+    try:
+        from . import monocleaner
+    except (SystemError, ImportError):
+        import monocleaner
+
+    with TemporaryDirectory() as model_dir:
+        if args.model_dir is None:
+            # One model of each variant, the first one is used to time the stages
+            models = {}
+            for name, structure, quantize_bits in MODEL_VARIANTS:
+                logging.info(f"Training a small {name} model")
+                variant_dir = os.path.join(model_dir, name)
+                os.mkdir(variant_dir)
+                train_model(corpus, args.language, variant_dir, structure, quantize_bits)
+                models[name] = os.path.join(variant_dir, "lm." + args.language)
+            args.model_dir = os.path.join(model_dir, MODEL_VARIANTS[0][0])
+        else:
+            models = None
+
+        options = [args.model_dir] + (["--debug"] if args.debug else []) + (["-q"] if args.quiet else [])
+        scoring_args = monocleaner.argument_parser().parse_args(options)
+        monocleaner.setup(scoring_args)
+        if models is None:
+            models = {"model": scoring_args.lm_file}
+
+        results["stages"] = bench_stages(args, scoring_args, corpus)
+        results["loading"] = bench_loading(models, args.load_methods, scoring_args.ff._tokenize_batch(corpus), args.repeat)
+
+    json.dump(results, args.output, indent=2)
+    args.output.write("\n")
+
+def main():
+    args = initialization()
+    perform_benchmark(args)
+
+if __name__ == "__main__":
+    main()
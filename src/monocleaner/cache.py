@@ -0,0 +1,63 @@
+from collections import OrderedDict
+import hashlib
+import dbm
+
+
+class ScoreCache:
+    '''
+    Score, identified language and hardrules tag of already scored sentences.
+    Kept in a bounded in-memory LRU and, optionally, in an on-disk dbm
+    keyed by a hash of the model identity and the sentence.
+    '''
+
+    def __init__(self, size: int, path: str = None, identity: str = ""):
+        """
+            size: maximum number of sentences kept in memory, 0 disables it
+            path: dbm file to store results across runs
+            identity: model and options the results depend on
+        """
+        self.size = size
+        self.memory = OrderedDict()
+        self.disk = dbm.open(path, 'c') if path else None
+        self.salt = hashlib.blake2b(identity.encode("utf-8")).digest()
+        self.hits = 0
+        self.misses = 0
+
+    def _disk_key(self, sentence):
+        return hashlib.blake2b(sentence.encode("utf-8"), key=self.salt, digest_size=16).digest()
+
+    def _remember(self, sentence, result):
+        if self.size:
+            self.memory[sentence] = result
+            if len(self.memory) > self.size:
+                self.memory.popitem(last=False)
+
+    def get(self, sentence):
+        ''' Return the cached (score, langid, tag) of a sentence or None '''
+        result = self.memory.get(sentence)
+        if result is not None:
+            self.memory.move_to_end(sentence)
+        elif self.disk is not None:
+            value = self.disk.get(self._disk_key(sentence))
+            if value is not None:
+                score, langid, tag = value.decode("utf-8").split("\t")
+                result = (float(score) if tag == "keep" else 0, langid or None, tag)
+                self._remember(sentence, result)
+
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, sentence, result):
+        self._remember(sentence, result)
+        if self.disk is not None:
+            score, langid, tag = result
+            value = f"{score!r}\t{langid or ''}\t{tag}"
+            self.disk[self._disk_key(sentence)] = value.encode("utf-8")
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
@@ -0,0 +1,163 @@
+from collections import deque
+from itertools import islice
+from timeit import default_timer
+import logging
+import yaml
+import sys
+import io
+import os
+
+try:
+    from .util import check_positive
+except (SystemError, ImportError):
+    from util import check_positive
+
+
+def add_checkpoint_arguments(parser):
+    ''' Checkpoint options of the scoring command '''
+    parser.add_argument("--checkpoint", type=str, help="File where the input lines scored and the output written are recorded periodically, so that an interrupted run can be resumed with --resume. Needs an uncompressed output file")
+    parser.add_argument("--checkpoint_interval", default=300, type=check_positive, help="Seconds between checkpoints")
+    parser.add_argument("--resume", action='store_true', help="Resume the run recorded in --checkpoint: skip the input lines already scored and truncate the output written after the checkpoint")
+
+def read_checkpoint(args):
+    ''' State of the run to be resumed, None if it has to start from the beginning '''
+    if args.resume and not args.checkpoint:
+        logging.error("--resume needs the --checkpoint file of the run")
+        sys.exit(1)
+    if not args.resume:
+        return None
+    if not os.path.exists(args.checkpoint):
+        logging.warning(f"Checkpoint {args.checkpoint} not found, starting from the beginning")
+        return None
+    with open(args.checkpoint) as file_:
+        return yaml.safe_load(file_)
+
+def create_checkpoint(args):
+    ''' Checkpoint requested by the options, a no-op if they are disabled '''
+    if not args.checkpoint:
+        return NULL_CHECKPOINT
+    return Checkpoint(args.checkpoint, args.checkpoint_interval, args.input, args.output, args.checkpoint_state)
+
+def _plain_file(file_):
+    ''' Whether file_ is an uncompressed text file that can be positioned by byte offset '''
+    return isinstance(getattr(file_, "buffer", None), (io.BufferedReader, io.BufferedWriter, io.BufferedRandom)) \
+        and file_.seekable()
+
+
+class Checkpoint():
+    '''
+    Input lines scored and output written, recorded when whole blocks have been
+    written so that a block is either committed or scored again on resume.
+    The output is flushed to disk before the checkpoint file is replaced.
+    '''
+    enabled = True
+
+    def __init__(self, path, interval, input, output, state=None):
+        """
+            input, output: files of the run, output must be an uncompressed file
+            state: checkpoint of the run being resumed
+        """
+        self.path = path
+        self.interval = interval
+        self.input = input
+        self.output = output
+        self.last_write = default_timer()
+        self.input_lines = 0
+        # Byte offsets are only kept for plain files where they can be used to seek
+        self.input_offset = 0 if _plain_file(input) else None
+        self.pending = deque() # lines and bytes of the blocks read and not written yet
+
+        if output is sys.stdout or not _plain_file(output):
+            logging.error("--checkpoint needs an uncompressed output file")
+            sys.exit(1)
+        if state is not None:
+            self.resume(state)
+
+    def resume(self, state):
+        ''' Position the input after the lines already scored and the output after the committed lines '''
+        if state["input"] != self.input.name or state["output"] != self.output.name:
+            logging.error(f"Checkpoint {self.path} belongs to the run of {state['input']} into {state['output']}")
+            sys.exit(1)
+
+        output_size = self.output.seek(0, io.SEEK_END)
+        if output_size < state["output_offset"]:
+            logging.error(f"Output {self.output.name} is shorter than recorded in checkpoint {self.path}")
+            sys.exit(1)
+        # Lines written after the checkpoint are scored again
+        self.output.seek(state["output_offset"])
+        self.output.truncate()
+
+        self.input_lines = state["input_lines"]
+        if self.input_offset is not None and state["input_offset"] is not None:
+            # With no decoder state, the position of a text file is its byte offset
+            self.input.seek(state["input_offset"])
+            self.input_offset = state["input_offset"]
+        else:
+            # Compressed input or stdin, read up to the first line not scored
+            self.input_offset = None
+            skipped = sum(1 for _ in islice(self.input, self.input_lines))
+            if skipped < self.input_lines:
+                logging.error(f"Input {self.input.name} is shorter than recorded in checkpoint {self.path}")
+                sys.exit(1)
+        logging.info(f"Resuming after {self.input_lines} input lines")
+
+    def track(self, blocks):
+        ''' Remember the size of each block read, to count it when its output is written '''
+        for block in blocks:
+            lines = block[1]
+            size = len("".join(lines).encode("utf-8")) if self.input_offset is not None else 0
+            self.pending.append((len(lines), size))
+            yield block
+
+    def block_written(self):
+        ''' Count the oldest block read as written, blocks are written in input order '''
+        lines, size = self.pending.popleft()
+        self.input_lines += lines
+        if self.input_offset is not None:
+            self.input_offset += size
+
+    def write(self, writer):
+        ''' Flush the output written by writer to disk and record it, replacing the checkpoint at once '''
+        self.last_write = default_timer()
+        writer.flush()
+        os.fsync(self.output.fileno())
+        # Offsets are only right if newlines were not translated when reading
+        if self.input_offset is not None and getattr(self.input, "newlines", None) not in (None, "\n"):
+            self.input_offset = None
+        state = {"input": self.input.name,
+                 "output": self.output.name,
+                 "input_lines": self.input_lines,
+                 "input_offset": self.input_offset,
+                 "output_offset": self.output.tell()}
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file_:
+            yaml.safe_dump(state, file_)
+            file_.flush()
+            os.fsync(file_.fileno())
+        os.replace(temp_path, self.path)
+
+    def checkpoint(self, writer):
+        ''' Write the checkpoint if the interval has passed since the last one '''
+        if default_timer() - self.last_write >= self.interval:
+            self.write(writer)
+
+
+class NullCheckpoint():
+    ''' Checkpoint that records nothing, used when checkpointing is disabled '''
+    enabled = False
+    input_lines = 0
+
+    def track(self, blocks):
+        return blocks
+
+    def block_written(self):
+        pass
+
+    def write(self, writer):
+        pass
+
+    def checkpoint(self, writer):
+        pass
+
+
+NULL_CHECKPOINT = NullCheckpoint()
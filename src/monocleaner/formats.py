@@ -0,0 +1,272 @@
+from argparse import ArgumentTypeError
+import logging
+import json
+import sys
+
+try:
+    from .util import CompressedFileType, read_blocks_async, iterate_async
+except (SystemError, ImportError):
+    from util import CompressedFileType, read_blocks_async, iterate_async
+
+# Input and output formats, tsv is read and written by the scoring commands themselves
+FORMATS = ["tsv", "jsonl", "parquet"]
+# Fields or columns added to each record
+SCORE_FIELD = "monocleaner_score"
+LANG_FIELD = "monocleaner_lang"
+TAG_FIELD = "monocleaner_tag"
+
+COMPRESSED_EXTENSIONS = (".gz", ".xz", ".zst")
+
+
+def add_format_arguments(parser, lang_field=False):
+    ''' Input and output format options of the scoring commands '''
+    parser.add_argument("--format", choices=FORMATS, help="Format of the input and output. tsv: tab-separated text with the sentence in --scol. jsonl: a JSON object per line with the sentence in --text_field. parquet: a Parquet file with the sentence in the --text_field column. When omitted, it is detected by the input or output file extension (.jsonl, .parquet), tsv otherwise")
+    parser.add_argument("--text_field", default="text", type=str, help="Field of the JSONL objects or Parquet column with the sentence")
+    if lang_field:
+        parser.add_argument("--lang_field", type=str, help="Field of the JSONL objects or Parquet column with the language, like --lang_col for tab-separated text")
+
+def detect_format(path):
+    ''' Format of a file according to its extension '''
+    if path is None or path == '-':
+        return None
+    for extension in COMPRESSED_EXTENSIONS:
+        if path.endswith(extension):
+            path = path[:-len(extension)]
+    if path.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    if path.endswith(".parquet"):
+        return "parquet"
+    return None
+
+def create_format(args):
+    ''' Record format of the input and output, None for tab-separated text '''
+    if args.format is None:
+        args.format = detect_format(args.input) or detect_format(args.output) or "tsv"
+    # Records are written in the format they are read
+    output_format = detect_format(args.output)
+    if output_format is not None and output_format != args.format:
+        logging.error(f"Output {args.output} is not in the {args.format} format of the input")
+        sys.exit(1)
+    lang_field = getattr(args, "lang_field", None)
+    if args.format == "tsv":
+        if lang_field:
+            logging.error("--lang_field is only for jsonl and parquet formats, use --lang_col")
+            sys.exit(1)
+        return None
+    if getattr(args, "lang_col", None):
+        logging.error(f"--lang_col is only for tab-separated text, use --lang_field with {args.format} format")
+        sys.exit(1)
+    if args.format == "jsonl":
+        return JsonlFormat(args.text_field, lang_field)
+    return ParquetFormat(args.text_field, lang_field)
+
+def open_input(args, parser):
+    ''' Set the record format and open the input path, stdin if omitted '''
+    args.record_format = create_format(args)
+    if args.format == "parquet":
+        args.input = args.record_format.open_input(args.input)
+    elif args.input is None or args.input == '-':
+        args.input = sys.stdin
+    else:
+        try:
+            args.input = CompressedFileType('r')(args.input)
+        except ArgumentTypeError as e:
+            parser.error(f"argument input: {e}")
+
+def open_output(args, parser, mode='w'):
+    ''' Open the output path in the format of the input, stdout if omitted '''
+    if args.format == "parquet":
+        args.output = args.record_format.open_output(args.output, mode)
+    elif args.output is None or args.output == '-':
+        args.output = sys.stdout
+    else:
+        try:
+            args.output = CompressedFileType(mode)(args.output)
+        except ArgumentTypeError as e:
+            parser.error(f"argument output: {e}")
+
+
+class JsonlFormat():
+    '''
+    A JSON object per line. The added fields are appended to the text of each
+    object, the rest of it is written unchanged.
+    Records are lines, so they are read, checkpointed and sent to workers like tab-separated text.
+    '''
+
+    def __init__(self, text_field, lang_field=None):
+        self.text_field = text_field
+        self.lang_field = lang_field
+
+    def read_blocks(self, input, block_size, nline=0):
+        return read_blocks_async(input, block_size, nline=nline)
+
+    def parse(self, lines, nline):
+        '''
+        Records, sentences and languages (None without lang_field) of a block.
+        The sentence is None in lines that are not JSON objects and in records
+        without the text or language fields.
+        '''
+        records = []
+        sentences = []
+        languages = [] if self.lang_field else None
+        for line in lines:
+            nline += 1
+            line = line.rstrip("\n")
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if not isinstance(record, dict):
+                logging.error(f" no JSON object on line {nline}")
+                record = None
+                sentence = None
+            else:
+                sentence = record.get(self.text_field)
+                if not isinstance(sentence, str):
+                    logging.error(f" text_field ({self.text_field}) missing on line {nline}")
+                    sentence = None
+            if languages is not None:
+                language = record.get(self.lang_field) if record is not None else None
+                if not isinstance(language, str):
+                    if sentence is not None:
+                        logging.error(f" lang_field ({self.lang_field}) missing on line {nline}")
+                    sentence = language = None
+                languages.append(language.strip() if language is not None else None)
+            records.append((line, record))
+            sentences.append(sentence)
+        return records, sentences, languages
+
+    def empty_records(self):
+        return []
+
+    def format(self, records, fields, fields_only=False):
+        '''
+        Output lines of records with fields, a list of names and values of each record.
+        Lines that are not JSON objects are replaced by an object with the fields.
+        '''
+        names = [name for name, _ in fields]
+        output = []
+        for i, (line, record) in enumerate(records):
+            added = {name: values[i] for name, values in fields}
+            if fields_only or record is None:
+                output.append(json.dumps(added, ensure_ascii=False))
+            elif record and not any(name in record for name in names):
+                line = line.rstrip()
+                output.append(f"{line[:-1]}, {json.dumps(added, ensure_ascii=False)[1:]}")
+            else:
+                # Fields that are already there are replaced
+                record.update(added)
+                output.append(json.dumps(record, ensure_ascii=False))
+        return "".join(line + "\n" for line in output)
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        logging.error("pyarrow is needed for Parquet files, install it with 'pip install pyarrow'")
+        sys.exit(1)
+    return pyarrow
+
+class ParquetFormat():
+    '''
+    Parquet files read in record batches. The added fields are appended as
+    columns of each batch, the other columns are written unchanged.
+    '''
+
+    def __init__(self, text_field, lang_field=None):
+        self.pa = _import_pyarrow()
+        self.text_field = text_field
+        self.lang_field = lang_field
+        self.schema = None
+        # The added columns have the same types whichever command writes them and whatever their values
+        self.field_types = {SCORE_FIELD: self.pa.float64(), LANG_FIELD: self.pa.string(), TAG_FIELD: self.pa.string()}
+
+    def open_input(self, path):
+        if path is None or path == '-':
+            logging.error("Parquet input needs a file, it can't be read from stdin")
+            sys.exit(1)
+        try:
+            input = self.pa.parquet.ParquetFile(path)
+        except (OSError, self.pa.ArrowException) as e:
+            logging.error(f"can't open '{path}': {e}")
+            sys.exit(1)
+        names = input.schema_arrow.names
+        for option, column in (("--text_field", self.text_field), ("--lang_field", self.lang_field)):
+            if column is not None and column not in names:
+                logging.error(f"{option} column '{column}' not found in {path}, columns: {' '.join(names)}")
+                sys.exit(1)
+        input.name = path
+        self.schema = input.schema_arrow
+        return input
+
+    def open_output(self, path, mode):
+        if mode != 'w':
+            logging.error("Parquet output can't be resumed or appended to")
+            sys.exit(1)
+        if path is None or path == '-':
+            return ParquetOutput(self.pa, sys.stdout.buffer, '<stdout>')
+        return ParquetOutput(self.pa, path, path)
+
+    def read_blocks(self, input, block_size, nline=0):
+        def batches(nline):
+            for batch in input.iter_batches(batch_size=block_size):
+                yield nline, batch
+                nline += batch.num_rows
+        return iterate_async(batches(nline))
+
+    def parse(self, batch, nline):
+        '''
+        Records, sentences and languages (None without lang_field) of a record
+        batch. The sentence is None in rows with null text or language.
+        '''
+        sentences = [s if s is None else str(s) for s in batch.column(batch.schema.get_field_index(self.text_field)).to_pylist()]
+        languages = None
+        if self.lang_field:
+            languages = batch.column(batch.schema.get_field_index(self.lang_field)).to_pylist()
+            languages = [l if l is None else str(l).strip() for l in languages]
+            sentences = [s if l is not None else None for s, l in zip(sentences, languages)]
+        for i, sentence in enumerate(sentences):
+            if sentence is None:
+                logging.error(f" null {self.text_field} or {self.lang_field} on row {nline + i + 1}" if self.lang_field
+                              else f" null {self.text_field} on row {nline + i + 1}")
+        return self.pa.Table.from_batches([batch]), sentences, languages
+
+    def empty_records(self):
+        return self.schema.empty_table()
+
+    def format(self, records, fields, fields_only=False):
+        ''' Table of records with fields, a list of names and values of each record '''
+        arrays = [(name, self.pa.array(values, type=self.field_types.get(name))) for name, values in fields]
+        if fields_only:
+            return self.pa.Table.from_arrays([array for _, array in arrays], names=[name for name, _ in arrays])
+        for name, array in arrays:
+            index = records.schema.get_field_index(name)
+            if index == -1:
+                records = records.append_column(name, array)
+            else:
+                records = records.set_column(index, name, array)
+        return records
+
+class ParquetOutput():
+    ''' Parquet file written table by table, with the schema of the first one '''
+
+    def __init__(self, pa, file_, name):
+        self.pa = pa
+        self.file = file_
+        self.name = name
+        self.writer = None
+
+    def write(self, table):
+        if self.writer is None:
+            self.writer = self.pa.parquet.ParquetWriter(self.file, table.schema)
+        self.writer.write_table(table)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        ''' Write the file footer, the file is not valid until then. The commands write an empty table for empty inputs '''
+        if self.writer is not None:
+            self.writer.close()
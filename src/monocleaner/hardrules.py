@@ -1,27 +1,82 @@
-from unicodedata import category as cat
 from timeit import default_timer
+from functools import lru_cache
 from fastspell import FastSpell
 from inspect import getmembers
 import unicodedata
 import argparse
 import logging
+import numpy
 import regex
+import yaml
 import sys
-import re
 import os
 
 try:
     from . import __version__
-    from .util import logging_setup, check_positive
+    from .metrics import NULL_METRICS, add_metrics_arguments, create_metrics
+    from .util import logging_setup, check_positive, check_positive_or_zero, check_positive_or_zero_float, \
+        read_blocks_async, AsyncWriter
+    from .repeats import repeated_words, repeated_substrings
+    from .formats import SCORE_FIELD, LANG_FIELD, TAG_FIELD, add_format_arguments, open_input, open_output
 except (SystemError, ImportError):
     from monocleaner import __version__
-    from util import logging_setup, check_positive
+    from metrics import NULL_METRICS, add_metrics_arguments, create_metrics
+    from util import logging_setup, check_positive, check_positive_or_zero, check_positive_or_zero_float, \
+        read_blocks_async, AsyncWriter
+    from repeats import repeated_words, repeated_substrings
+    from formats import SCORE_FIELD, LANG_FIELD, TAG_FIELD, add_format_arguments, open_input, open_output
+
+# Code points classified in advance by char_tables, the Basic Multilingual Plane.
+# The characters of the statistics are all in it, the rest are classified when seen
+CHAR_TABLES_SIZE = 0x10000
+
+@lru_cache(maxsize=None)
+def char_tables():
+    '''
+    Column of each code point of the table in the character statistics (0 for none, else column + 1)
+    and whether it is [[:alpha:]], [[:digit:]] and [\\x80-\\xFF], built on first use
+    '''
+    columns = numpy.zeros(CHAR_TABLES_SIZE, dtype=numpy.uint8)
+    for char, column in STATS_CHARS.items():
+        columns[ord(char)] = column + 1
+    all_chars = "".join(map(chr, range(CHAR_TABLES_SIZE)))
+    flags = []
+    for char_regex in CHAR_FLAG_REGEXES:
+        flag = numpy.zeros(CHAR_TABLES_SIZE, dtype=bool)
+        for match in regex.finditer(char_regex.pattern + "+", all_chars):
+            flag[match.start():match.end()] = True
+        flags.append(flag)
+    return columns, flags
+
+def char_stats_batch(sentences):
+    ''' Character statistics of each sentence, counted in one pass over all their code points '''
+    if not sentences:
+        return []
+    columns, flags = char_tables()
+    code_points = numpy.frombuffer("".join(sentences).encode("utf-32-le", "surrogatepass"), dtype=numpy.uint32)
+    outside = code_points >= CHAR_TABLES_SIZE
+    any_outside = outside.any()
+    table_points = numpy.where(outside, 0, code_points) if any_outside else code_points
+    if any_outside:
+        distinct, inverse = numpy.unique(code_points[outside], return_inverse=True)
+    sentence_ids = numpy.repeat(numpy.arange(len(sentences)), [len(s) for s in sentences])
+    num_columns = ST_ALPHA + 1
+    counts = numpy.bincount(sentence_ids * num_columns + columns[table_points], minlength=len(sentences) * num_columns)
+    counts = [counts.reshape(len(sentences), num_columns)[:, 1:]]
+    for flag, char_regex in zip(flags, CHAR_FLAG_REGEXES):
+        values = flag[table_points]
+        if any_outside:
+            # Code points outside the table are classified once each
+            values[outside] = numpy.array([char_regex.match(chr(c)) is not None for c in distinct])[inverse]
+        counts.append(numpy.bincount(sentence_ids, weights=values, minlength=len(sentences))
+                      .astype(numpy.int64)[:, None])
+    return numpy.hstack(counts).tolist()
 
-tbl_non_alpha = [chr(i) for i in range(sys.maxunicode) if not cat(chr(i)).startswith('L')]
-tbl_non_alpha = str.maketrans('', '', ''.join(tbl_non_alpha))
-regex_blank = regex.compile("[ \u00A0]")
 regex_alpha = regex.compile("[[:alpha:]]")
 regex_numbers = regex.compile("[[:digit:]]")
+regex_high = regex.compile("[\x80-\xFF]")
+# Character classes counted by char_stats_batch
+CHAR_FLAG_REGEXES = (regex_alpha, regex_numbers, regex_high)
 regex_url = regex.compile(r"(http(s)?:\/\/.)?(www\.)?[-a-zA-Z0-9@:%._\+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)")
 #regex_breadcrumbs = regex.compile("([ ][-/»][ ]|[|<>→←]|[ ][:][:][ ])")
 regex_breadcrumbs1 = regex.compile("([ ][-/][ ]|[<>*]|[ ][:][ ])")
@@ -29,14 +84,11 @@ regex_breadcrumbs2 = regex.compile("([ ][»][ ]|[|→←•·¬])")
 regex_unicode_noise = regex.compile("[\x80-\xFF]{3,}")
 regex_unicode_noise_relaxed = regex.compile("[\x80-\xFF]{7,}")
 regex_spaces_noise = regex.compile("([ ]\D){4,}[ ]")
-regex_paren = r"\[|\]|\(|\)|{|}|⟨|⟩"
 regex_unwanted = regex.compile("[+*]")
 regex_inconditional = regex.compile("=\"")
 regex_escaped_unicode = regex.compile("[\\\\][xu][0-9a-fA-F]{2,}")
 #regex_glued_words = regex.compile("\b[[:alpha:]]*[[:lower:]][[:upper:]][[:alpha:]]*)
 regex_glued_words = regex.compile("([[:alpha:]]*[[:upper:]]{1}[[:lower:]]+){3}")
-regex_repeated_words = regex.compile(r"(?i)(\b\S+(.+))\s+\b\1\b")
-regex_repeated_without_words = regex.compile(r"(.+)\1")
 safe_noise_detection_langs = {"en", "es", "fr", "pl", "de", "it", "pt", "nl", "cs", "ro", "fi", "lv", "et", "bg", "hr", "da", "hu", "ga", "eu", "gl", "sl", "sv", "mt", "sk", "is", "lt", "nb", "nn", "no"}
 
 #similar_pairs = [{"es","ca"}, {"es","gl"}, {"pt","gl"}, {"no","nn"}, {"no", "da"}]
@@ -44,6 +96,19 @@ atilde_langs = {"pt"}
 acumflex_langs = {"cy", "fr", "fa", "it", "pt", "tr", "vi",}
 CJK = {"zh", "ja", "ko", "yue", "bo", "bod"}
 
+# Columns of the character statistics of a sentence: counts of blanks, of each
+# bracket, of the characters of bad encoding and literals, and of [[:alpha:]],
+# [[:digit:]] and [\x80-\xFF] characters
+(ST_BLANK, ST_SQUARE_OPEN, ST_SQUARE_CLOSE, ST_CURLY_OPEN, ST_CURLY_CLOSE, ST_ANGLE_OPEN, ST_ANGLE_CLOSE,
+ ST_PAREN_OPEN, ST_PAREN_CLOSE, ST_ATILDE, ST_ACIRCUMFLEX, ST_PERCENT, ST_PLUS, ST_STAR, ST_EQUALS, ST_COLON,
+ ST_ALPHA, ST_DIGIT, ST_HIGH) = range(19)
+STATS_CHARS = {" ": ST_BLANK, "\u00A0": ST_BLANK, "[": ST_SQUARE_OPEN, "]": ST_SQUARE_CLOSE,
+               "{": ST_CURLY_OPEN, "}": ST_CURLY_CLOSE, "⟨": ST_ANGLE_OPEN, "⟩": ST_ANGLE_CLOSE,
+               "(": ST_PAREN_OPEN, ")": ST_PAREN_CLOSE, "Ã": ST_ATILDE, "Â": ST_ACIRCUMFLEX,
+               "%": ST_PERCENT, "+": ST_PLUS, "*": ST_STAR, "=": ST_EQUALS, ":": ST_COLON}
+# Number of distinct lowercased sentences whose identified language is remembered
+LANGID_CACHE_SIZE = 2**16
+
 
 class Hardrules():
 
@@ -53,9 +118,51 @@ class Hardrules():
         self.fastspell = args.fastspell
         self.detect_script = args.detect_script
         self.disable_lang_ident = args.disable_lang_ident
+        # Language identified for each lowercased sentence, memoized for repeated ones
+        self.identify_language = lru_cache(maxsize=LANGID_CACHE_SIZE)(self._identify_language)
+        # Character statistics of the sentences of the block being processed
+        self.block_stats = {}
+
+        # Seconds each rule can spend on a sentence, rules running out of time discard it
+        self.rules_timeout = args.rules_timeout
+        self.regex_timeout = args.rules_timeout or None
+        # Rules that ran out of time on the sentence being checked
+        self.timed_out = set()
 
         # Get all rule names to be called in a loop as functions
-        self.rules = {n: f for n, f in getmembers(self) if n.startswith('c_')}
+        self.rules = {n: self._budgeted(n, f) for n, f in getmembers(self) if n.startswith('c_')}
+
+        # Rules are run in report order until enough sentences have been seen
+        # to know their cost and discard rate, then they are scheduled
+        # cheapest and most discarding first
+        self.rules_warmup = args.rules_warmup
+        self.rules_profile = args.rules_profile
+        self.rules_stats = {n: [0, 0, 0.0] for n in self.rules} # runs, discarded, time
+        self.sampled = 0
+        self.schedule_rules(list(self.rules))
+        if self.rules_profile and os.path.exists(self.rules_profile):
+            self.load_rules_profile()
+
+    def _budgeted(self, rule_name, rule):
+        ''' Rule discarding the sentence if it runs out of time, recording it in timed_out '''
+        def budgeted(sentence):
+            try:
+                return rule(sentence)
+            except TimeoutError:
+                self.timed_out.add(rule_name)
+                return False
+        return budgeted
+
+    def analyze(self, sentences):
+        ''' Count the character statistics of a block of sentences at once, for the rules to read them '''
+        self.block_stats = dict(zip(sentences, char_stats_batch(sentences)))
+
+    def char_stats(self, sentence):
+        ''' Character statistics of a sentence, counted on its own if it is not in the analyzed block '''
+        stats = self.block_stats.get(sentence)
+        if stats is None:
+            stats = char_stats_batch([sentence])[0]
+        return stats
 
     def c_no_empty(self, sentence):
         return sentence != ""
@@ -77,19 +184,20 @@ class Hardrules():
             return len(sentence) >= 3
 
         """ Counts number of whitespace, requires >= 2 (3 words) """
-        return len(regex_blank.findall(sentence)) >= 2
+        return self.char_stats(sentence)[ST_BLANK] >= 2
 
     def c_no_bad_encoding(self, sentence):
-        if self.language not in atilde_langs and 'Ã' in sentence:
+        stats = self.char_stats(sentence)
+        if self.language not in atilde_langs and stats[ST_ATILDE]:
             return False
-        if self.language not in acumflex_langs and 'Â' in sentence:
+        if self.language not in acumflex_langs and stats[ST_ACIRCUMFLEX]:
             return False
         return True
 
     def c_no_only_symbols(self, sentence):
         if len(sentence) == 0:
             return True
-        return len(regex_alpha.findall(sentence)) / len(sentence) > 0.1
+        return self.char_stats(sentence)[ST_ALPHA] / len(sentence) > 0.1
 
     def c_no_only_numbers(self, sentence):
         threshold = 0.5
@@ -97,114 +205,252 @@ class Hardrules():
             threshold = 0.7
         if len(sentence) == 0:
             return True
-        return len(regex_numbers.findall(sentence)) / len(sentence) < threshold
+        return self.char_stats(sentence)[ST_DIGIT] / len(sentence) < threshold
 
     def c_no_urls(self, sentence):
-        return len(regex_url.findall(sentence)) == 0
+        return len(regex_url.findall(sentence, timeout=self.regex_timeout)) == 0
 
     def c_no_breadcrumbs(self, sentence):
-        return len(regex_breadcrumbs1.findall(sentence)) < 3 \
-                or len(regex_breadcrumbs2.findall(sentence)) < 2
+        return len(regex_breadcrumbs1.findall(sentence, timeout=self.regex_timeout)) < 3 \
+                or len(regex_breadcrumbs2.findall(sentence, timeout=self.regex_timeout)) < 2
 
     def c_no_unicode_noise(self, sentence):
         # Icelandic can have words with three or four high unicode values like 'þýðir'
         # Finish sometimes too
+        # Noise needs consecutive high characters, only look for it if there are enough
+        high = self.char_stats(sentence)[ST_HIGH]
         if self.language in ('is', 'fi'):
-            return len(regex_unicode_noise_relaxed.findall(sentence)) == 0
+            return high < 7 or len(regex_unicode_noise_relaxed.findall(sentence, timeout=self.regex_timeout)) == 0
         else:
-            return len(regex_unicode_noise.findall(sentence)) == 0
+            return high < 3 or len(regex_unicode_noise.findall(sentence, timeout=self.regex_timeout)) == 0
 
     def c_no_space_noise(self, sentence):
-        return len(regex_spaces_noise.findall(sentence)) == 0
+        return len(regex_spaces_noise.findall(sentence, timeout=self.regex_timeout)) == 0
 
     def c_no_paren(self, sentence):
-        if len(re.findall(regex_paren, sentence)): #there are parentheses
-            char_count = {i: sentence.count(i) for i in set(sentence)}
-            
-            if (((char_count.get("[") or 0) + (char_count.get("]") or 0)) > 6 ) or (char_count.get("[") or 0) != (char_count.get("]") or 0): #max 6 [ or ], having the same [ and ] 
-                return False            
-            if (((char_count.get("{") or 0) + (char_count.get("}") or 0)) > 6 ) or (char_count.get("{") or 0) != (char_count.get("}") or 0): #max than 6 { or }, having the same { and }
-                return False           
-            if (((char_count.get("⟨") or 0) + (char_count.get("⟩") or 0)) > 6 ) or (char_count.get("⟨") or 0) != (char_count.get("⟩") or 0): #max than 6 ⟨ or ⟩, having the same ⟨ and ⟩            
-                return False
-            
-            opening_paren = char_count.get("(") or 0
-            closing_paren = char_count.get(")") or 0
-            if opening_paren == closing_paren: #any amount of  () is allowed, as long as there are the same amount of  ( and )
-                return True
-            else:
+        stats = self.char_stats(sentence)
+        square = (stats[ST_SQUARE_OPEN], stats[ST_SQUARE_CLOSE])
+        curly = (stats[ST_CURLY_OPEN], stats[ST_CURLY_CLOSE])
+        angle = (stats[ST_ANGLE_OPEN], stats[ST_ANGLE_CLOSE])
+        for opening, closing in (square, curly, angle):
+            if opening + closing > 6 or opening != closing: #max 6 of each kind, having the same opening and closing
                 return False
-        return True    
+        #any amount of () is allowed, as long as there are the same amount of ( and )
+        return stats[ST_PAREN_OPEN] == stats[ST_PAREN_CLOSE]
 
     def c_no_literals(self, sentence):
-        return not any(l in sentence for l in ["Re:","{{", "%s", "}}", "+++", "***", '=\"'])
+        # Only look for the literals whose characters are in the sentence
+        stats = self.char_stats(sentence)
+        return not ((stats[ST_COLON] and "Re:" in sentence)
+                    or (stats[ST_CURLY_OPEN] >= 2 and "{{" in sentence)
+                    or (stats[ST_PERCENT] and "%s" in sentence)
+                    or (stats[ST_CURLY_CLOSE] >= 2 and "}}" in sentence)
+                    or (stats[ST_PLUS] >= 3 and "+++" in sentence)
+                    or (stats[ST_STAR] >= 3 and "***" in sentence)
+                    or (stats[ST_EQUALS] and '=\"' in sentence))
 
     def c_no_escaped_unicode(self, sentence):
-        return len(regex_escaped_unicode.findall(sentence)) == 0
+        return len(regex_escaped_unicode.findall(sentence, timeout=self.regex_timeout)) == 0
 
     def c_no_glued_words(self, sentence):
-        return regex_glued_words.search(sentence) == None
+        return regex_glued_words.search(sentence, timeout=self.regex_timeout) == None
 
     def c_no_repeated_words(self, sentence):
-        our_regex = regex_repeated_without_words
-        if self.language in safe_noise_detection_langs:
-            our_regex = regex_repeated_words
-
         min_chars = 7
         if self.language in CJK:
             min_chars = 4
 
-        count = 0
-        for match_obj in regex.finditer(our_regex, sentence):
-            matching = match_obj.group().strip()
-            # if match does not have a minimum length continue without discarding
-            if len(matching) > min_chars:
-                r2 = regex.search("[[:alpha:]]", matching)
-                if r2:
-                    # if a certain count of repeated patterns has been reached, then return False
-                    count += 1
-                    if count >= 1:
-                        return False
+        # Repetitions longer than min_chars with letters discard the sentence,
+        # repeated words where word boundaries are reliable, any repeated substring elsewhere
+        deadline = default_timer() + self.rules_timeout if self.rules_timeout else None
+        if self.language in safe_noise_detection_langs:
+            return not repeated_words(sentence, min_chars, deadline, self.regex_timeout)
+        return not repeated_substrings(sentence, min_chars, deadline)
 
-        return True
+    def _identify_language(self, sentence):
+        ''' Return the language identified by FastSpell, with and without the script suffix '''
+        langid = self.fastspell.getlang(sentence)
+
+        # Separate langid from the detected script (only Serbo-Croatian is supported)
+        if self.detect_script:
+            return langid, langid.split('_')[0]
+        return langid, langid
 
     def z_no_wrong_language(self, sentence):
         if (not self.disable_lang_ident) and len(sentence) > 0:
             # Obtain fastspell prediction, lowercasing helps in small langs
-            langid = self.fastspell.getlang(sentence.lower())
+            _, langid_no_suffix = self.identify_language(sentence.lower())
 
-            # Separate langid from the detected script (only Serbo-Croatian is supported)
-            if self.detect_script:
-                langid_no_suffix = langid.split('_')[0]
-            else:
-                langid_no_suffix = langid
-                
             # Return language identified, else, return self.language
             if langid_no_suffix != self.language:
                 return langid_no_suffix, False
         return self.language, True
 
+    def enable_metrics(self, metrics):
+        ''' Count runs, discards and time of each rule in metrics '''
+        self.rules = {n: metrics.timed_rule(n.replace('c_', '', 1), f) for n, f in self.rules.items()}
+        self.schedule_rules(list(self.rules_rank))
+
+    def schedule_rules(self, order):
+        ''' Set the order rules are run when stopping at the first one discarded '''
+        self.rules_order = [(n, self.rules[n]) for n in order]
+        self.rules_rank = {n: i for i, n in enumerate(order)}
+
+    def rules_cost(self, rule_name):
+        ''' Expected time spent per discarded sentence when running the rule first '''
+        runs, discarded, elapsed = self.rules_stats[rule_name]
+        if runs == 0:
+            return 0.0
+        # Smooth the discard rate so rules that never discard keep a finite cost
+        return (elapsed / runs) / ((discarded + 1) / (runs + 2))
+
+    def load_rules_profile(self):
+        with open(self.rules_profile) as file_:
+            profile = yaml.safe_load(file_)
+        for rule_name, stats in profile.items():
+            if 'c_' + rule_name in self.rules_stats:
+                self.rules_stats['c_' + rule_name] = [stats['runs'], stats['discarded'], stats['time']]
+        self.schedule_rules(sorted(self.rules, key=self.rules_cost))
+        self.rules_warmup = 0
+        logging.debug(f"Hardrules order loaded from {self.rules_profile}: {list(self.rules_rank)}")
+
+    def save_rules_profile(self):
+        ''' Save the warm-up stats to the profile file if it didn't exist '''
+        if not self.rules_profile or os.path.exists(self.rules_profile) or self.sampled == 0:
+            return
+        profile = {n.replace('c_', '', 1): {'runs': runs, 'discarded': discarded, 'time': elapsed}
+                   for n, (runs, discarded, elapsed) in self.rules_stats.items()}
+        with open(self.rules_profile, 'w') as file_:
+            yaml.safe_dump(profile, file_)
+
+    def _profile_rules(self, sentence):
+        ''' Run all rules in report order collecting their cost and discard rate '''
+        discarded = []
+        for rule_name, rule in self.rules.items():
+            time_start = default_timer()
+            result = rule(sentence)
+            stats = self.rules_stats[rule_name]
+            stats[0] += 1
+            stats[2] += default_timer() - time_start
+            if not result:
+                stats[1] += 1
+                discarded.append(rule_name)
+
+        self.sampled += 1
+        if self.sampled == self.rules_warmup:
+            self.schedule_rules(sorted(self.rules, key=self.rules_cost))
+            logging.debug(f"Hardrules order after warm-up: {list(self.rules_rank)}")
+        return discarded
+
+    def _first_discarded(self, sentence, exact):
+        '''
+        Run rules in scheduled order and return the first that discards the sentence.
+        If exact, return the first one in report order, running those before it
+        that haven't been run yet.
+        '''
+        for position, (rule_name, rule) in enumerate(self.rules_order):
+            if not rule(sentence):
+                if exact:
+                    for previous, rule in self.rules.items():
+                        if previous == rule_name:
+                            break
+                        if self.rules_rank[previous] > position and not rule(sentence):
+                            return previous
+                return rule_name
+        return None
+
     def wrong_segment(self, args, sentence):
         if args.disable_hardrules:
             return 'keep'
 
-        discarded = []
-
-        for rule_name in self.rules:
-            rule = getattr(self, rule_name)
-            result = rule(sentence)
-
-            # If rule applied fails, then only add the rule name to discarded
-            if not result:
-                discarded.append(rule_name.replace('c_', '', 1))
-            
-            # If user doesn't want to run all rules, stop after the first one that fails
-            if not result and not args.run_all_rules:
-                return ''.join(discarded)
+        self.timed_out.clear()
+        if self.sampled < self.rules_warmup:
+            discarded = self._profile_rules(sentence)
+            # If user doesn't want to run all rules, only report the first one that fails
+            if not args.run_all_rules:
+                discarded = discarded[:1]
+        elif args.run_all_rules:
+            discarded = [n for n, rule in self.rules.items() if not rule(sentence)]
+        else:
+            # Which rule discards the sentence only matters when it is printed
+            discarded = self._first_discarded(sentence, exact=args.annotated_output)
+            discarded = [discarded] if discarded else []
 
         if discarded == []:
             return 'keep'
-        return '+'.join(discarded)
+        # Rules that ran out of time are tagged apart from the ones that discarded the sentence
+        return '+'.join(n.replace('c_', '', 1) + ('_timeout' if n in self.timed_out else '') for n in discarded)
+
+
+class ScoringPipeline():
+    '''
+    Score blocks of sentences in stages: hardrules, then language identification,
+    then the fluency filter. Each stage only runs on the sentences kept by the
+    previous ones. Without a fluency filter, kept sentences get score 1.
+    '''
+
+    def __init__(self, args, hardrules, fluency_filter=None, langid_discarded=False, metrics=NULL_METRICS):
+        """
+            hardrules: Hardrules of the language
+            fluency_filter: LMFluencyFilter scoring the kept sentences
+            langid_discarded: identify the language of sentences discarded by hardrules too
+            metrics: Metrics where the time of each stage and rule is recorded
+        """
+        self.args = args
+        self.hardrules = hardrules
+        self.fluency_filter = fluency_filter
+        self.langid_discarded = langid_discarded
+        self.metrics = metrics
+        if metrics.enabled:
+            hardrules.enable_metrics(metrics)
+            if fluency_filter is not None:
+                fluency_filter.metrics = metrics
+
+    def process(self, sentences):
+        ''' Return score, identified language and hardrules tag of each sentence '''
+        args = self.args
+        with self.metrics.stage("hardrules", len(sentences)):
+            if not args.disable_hardrules:
+                self.hardrules.analyze(sentences)
+            tags = [self.hardrules.wrong_segment(args, sentence) for sentence in sentences]
+        langids = [args.language] * len(sentences)
+
+        # Language identification, FastSpell is called once per distinct sentence
+        if not args.disable_lang_ident:
+            with self.metrics.stage("langid", len(sentences)):
+                for i, sentence in enumerate(sentences):
+                    if not sentence or not (self.langid_discarded or tags[i] == 'keep'):
+                        continue
+
+                    # Lowercasing helps in small langs
+                    langids[i], langid_no_suffix = self.hardrules.identify_language(sentence.lower())
+
+                    if not args.disable_hardrules and langid_no_suffix != args.language:
+                        if tags[i] == 'keep':
+                            tags[i] = 'no_wrong_language'
+                        elif args.run_all_rules:
+                            tags[i] += '+no_wrong_language'
+
+        # Fluency scoring of the kept sentences, all of them at once
+        scores = [0] * len(sentences)
+        keep = [i for i, tag in enumerate(tags) if tag == 'keep']
+        if self.fluency_filter is None:
+            for i in keep:
+                scores[i] = 1
+        elif keep:
+            # Includes the normalize, tokenize and kenlm stages
+            with self.metrics.stage("fluency", len(keep)):
+                lm_scores = self.fluency_filter.score_batch([sentences[i] for i in keep])
+            for i, score in zip(keep, lm_scores.tolist()):
+                scores[i] = score
+
+        return list(zip(scores, langids, tags))
+
+    def close(self):
+        ''' Save the hardrules warm-up stats and stop the tokenizer processes '''
+        self.hardrules.save_rules_profile()
+        if self.fluency_filter is not None:
+            self.fluency_filter.tokenizer.close()
 
 '''
 def c_unwanted(sentence):
@@ -219,8 +465,8 @@ def c_inconditional(sentence):
 def initialization():
     parser = argparse.ArgumentParser()
     parser.add_argument("language", type=str, help="Language code of corpus in ISO 639-1 format (2-char code).")
-    parser.add_argument("input", type=argparse.FileType('r'), nargs='?', help="Input file. If omitted, read from 'stdin'.")
-    parser.add_argument("output", type=argparse.FileType('w'), nargs='?', help="Output tab-separated text file adding monocleaner score. When omitted output will be written to stdout.")
+    parser.add_argument("input", type=str, nargs='?', help="Input file, .gz, .xz and .zst are decompressed. If omitted, read from 'stdin'.")
+    parser.add_argument("output", type=str, nargs='?', help="Output file in the input format adding monocleaner score, .gz, .xz and .zst are compressed. When omitted output will be written to stdout.")
     parser.add_argument("--scol", default=1, type=check_positive, help ="Sentence column (starting in 1)")
     parser.add_argument("--disable_lang_ident", action='store_true', help="Disables language identification in hardrules")
     parser.add_argument("--disable_minimal_length", action='store_true', help="Don't apply minimal length (3 words) rule")
@@ -231,18 +477,21 @@ def initialization():
     parser.add_argument("--annotated_output", action='store_true', help="Add hardrules annotation for each sentence")
     parser.add_argument("--run_all_rules", action='store_true', help="Run all hardrules for each sentence instead of stopping at the first one discarded")
     parser.add_argument('--dont_ignore_long', default=False, action='store_true', help="Don't ignore too long sentences")
+    parser.add_argument("--rules_warmup", default=1000, type=check_positive_or_zero, help="Number of sentences used to measure hardrules cost and discard rate before scheduling them. 0 runs them always in report order")
+    parser.add_argument("--rules_profile", type=str, help="File with hardrules cost and discard stats. If it exists, rules are scheduled with them and warm-up is skipped, otherwise warm-up stats are saved to it")
+    parser.add_argument("--rules_timeout", default=0, type=check_positive_or_zero_float, help="Seconds each hardrule can spend on a sentence. Sentences a rule runs out of time on are discarded with the rule tag followed by '_timeout'. 0 disables it")
+    parser.add_argument("--block_size", default=10000, type=check_positive, help="Number of lines processed at once")
+    add_format_arguments(parser)
+    add_metrics_arguments(parser)
     parser.add_argument("--debug", action='store_true')
     parser.add_argument("-q", "--quiet", action='store_true')
     parser.add_argument('-v', '--version', action='version', version="%(prog)s " + __version__, help="show version of this script and exit")
 
     args = parser.parse_args()
 
-    if args.output == None:
-        args.output = sys.stdout
-    if args.input == None:
-        args.input = sys.stdin
-
     logging_setup(args)
+    open_input(args, parser)
+    open_output(args, parser)
     logging.debug(args)
     
     if args.disable_lang_ident:
@@ -265,77 +514,123 @@ def initialization():
     
     return args
 
+def output_fields(args, scores, langids, tags):
+    ''' Names and values of the fields added to JSONL and Parquet records '''
+    # Scores are floats like the ones of monocleaner, so that both outputs can be put together
+    fields = [(SCORE_FIELD, [float(score) for score in scores])]
+    if args.add_lang_ident:
+        fields.append((LANG_FIELD, langids))
+    if args.annotated_output:
+        fields.append((TAG_FIELD, tags))
+    return fields
+
+def process_block(args, pipeline, lines, nline):
+    ''' Tag a block of input lines or JSONL and Parquet records, nline being the number of lines before it '''
+    if args.record_format is not None:
+        records, sentences, _ = args.record_format.parse(lines, nline)
+        tags = []
+        for i, sentence in enumerate(sentences):
+            if sentence is None:
+                sentences[i] = ""
+                tags.append("missing_columns")
+            elif not args.dont_ignore_long and len(sentence) > 1024:
+                tags.append("not_too_long")
+            else:
+                tags.append("")
+    else:
+        sentences = []
+        tags = []
+        for line in lines:
+            nline += 1
+            tag = ""
+            parts = line.rstrip("\n").split("\t")
+
+            if len(parts) >= args.scol:
+                sentence = parts[args.scol-1]
+            else:
+                logging.error(f" scol ({args.scol}) index above column number ({len(parts)}) on line {nline}")
+                sentence = ""
+                tag = "missing_columns"
+
+            if not args.dont_ignore_long and (len(line) > 1024):
+                tag = "not_too_long"
+
+            sentences.append(sentence)
+            tags.append(tag)
+
+    # Only the lines that have not been tagged yet go through the pipeline
+    results = iter(pipeline.process([s for s, t in zip(sentences, tags) if t == ""]))
+
+    output = []
+    scores = []
+    langids = []
+    with pipeline.metrics.stage("format", len(tags)):
+        for i, tag in enumerate(tags):
+            if tag == "":
+                score, langid, tag = next(results)
+                tags[i] = tag
+                # Identified language is printed without the detected script
+                if args.detect_script:
+                    langid = langid.split('_')[0]
+            else:
+                score, langid = 0, args.language
+            scores.append(score)
+            langids.append(langid)
+
+        if args.record_format is not None:
+            output = args.record_format.format(records, output_fields(args, scores, langids, tags), args.score_only)
+        else:
+            for line, score, langid, tag in zip(lines, scores, langids, tags):
+                # print sentence when no score_only
+                # print score
+                # print identified language if requested
+                # print hardrule annotation if requested
+                fields = []
+                if not args.score_only:
+                    fields.append(line.rstrip("\n"))
+                fields.append("{0}".format(score))
+                if args.add_lang_ident:
+                    fields.append(langid)
+                if args.annotated_output:
+                    fields.append(tag)
+                output.append('\t'.join(fields) + '\n')
+            output = ''.join(output)
+
+    pipeline.metrics.count_lines(len(lines), len(tags))
+    pipeline.metrics.count_tags(tags)
+    return output
+
 def main():
     args = initialization()
-    
+
     time_start = default_timer()
     logging.info("Start hardruling text")
-    
-    # TODO: add wrong_segment as method in hardrules
-    hardrules = Hardrules(args)
-    
-    nline = 0
 
-    for line in args.input:
-        nline += 1
-        tag = ""
-        parts = line.rstrip("\n").split("\t")
+    hardrules = Hardrules(args)
+    metrics = create_metrics(args)
+    # Language is identified for discarded sentences only when all rules are run
+    pipeline = ScoringPipeline(args, hardrules, langid_discarded=args.run_all_rules, metrics=metrics)
 
-        if len(parts) >= args.scol:
-            sentence = parts[args.scol-1]
+    nline = 0
+    with AsyncWriter(args.output) as output:
+        if args.record_format is not None:
+            blocks = args.record_format.read_blocks(args.input, args.block_size)
         else:
-            logging.error(f" scol ({args.scol}) index above column number ({len(parts)}) on line {nline}")
-            sentence = ""
-            tag = "missing_columns"
-            #continue
-        
-        
-        if not args.dont_ignore_long and (len(line) > 1024):
-            tag = "not_too_long"
-            #continue
-        
-        if tag == "":        
-            hr_result = hardrules.wrong_segment(args, sentence)
-            tag = hr_result
-            langid = args.language
-        
-            # Language identification rule and output
-            if (not args.disable_lang_ident) and len(line) > 0:
-                # If run all rules is enabled, run the identification method.
-                # If it doesn't pass, then set the tag accordingly if other hardrules have failed.
-                if args.run_all_rules:
-                    langid, res = hardrules.z_no_wrong_language(sentence)
-                    
-                    if not res:
-                        if tag == 'keep':
-                            tag = 'no_wrong_language'
-                        else:
-                            tag += '+no_wrong_language'
-                else:
-                    # If run all rules is disabled, then only run identification method when all other hardrules have passed
-                    if tag == 'keep':
-                        langid, res = hardrules.z_no_wrong_language(sentence)
-                        
-                        if not res:
-                            tag = 'no_wrong_language'
-        
-        score = 1
-        if tag != "keep":
-            score = 0
-        
-        # print sentence when no score_only
-        # print score
-        # print identified language if requested
-        # print hardrule annotation if requested
-        if not args.score_only:
-            args.output.write(line.rstrip("\n") + '\t')
-        args.output.write("{0}".format(score))
-        if args.add_lang_ident:
-            args.output.write('\t' + langid)
-        if args.annotated_output:
-            args.output.write('\t' + tag)
-        args.output.write("\n")
-        
+            blocks = read_blocks_async(args.input, args.block_size)
+        for block_nline, lines in blocks:
+            output.write(process_block(args, pipeline, lines, block_nline))
+            nline += len(lines)
+            metrics.checkpoint()
+        if args.record_format is not None and nline == 0:
+            # Empty inputs get an output with the fields too, Parquet files need their schema
+            output.write(args.record_format.format(args.record_format.empty_records(), output_fields(args, [], [], []), args.score_only))
+    if args.output is not sys.stdout:
+        # Compressed files are only complete once closed
+        args.output.close()
+
+    hardrules.save_rules_profile()
+    metrics.close()
+
     # Print elapsed time and avg speed
     logging.info("Finished")
     elapsed_time = default_timer() - time_start
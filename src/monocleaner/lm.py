@@ -1,8 +1,11 @@
 from tempfile import TemporaryFile, NamedTemporaryFile
 from subprocess import PIPE
+from itertools import islice
+from functools import lru_cache
 from enum import Enum
 import typing
 import kenlm
+import multiprocessing
 import subprocess
 import shutil
 import argparse
@@ -14,15 +17,48 @@ import sys
 import os
 
 try:
-    from .util import shuffle_file
-    from .tokenizer import Tokenizer
+    from .util import read_blocks, imap_bounded
+    from .tokenizer import Tokenizer, CharTokenizer
+    from .metrics import NULL_METRICS
     from .normalize import MosesPunctNormalizer
 except (SystemError, ImportError):
-    from util import shuffle_file
-    from tokenizer import Tokenizer
+    from util import read_blocks, imap_bounded
+    from tokenizer import Tokenizer, CharTokenizer
+    from metrics import NULL_METRICS
     from normalize import MosesPunctNormalizer
 
 
+# Lines tokenized at once when training and how often progress is reported
+TRAINING_BLOCK_SIZE = 10000
+TRAINING_PROGRESS_LINES = 1000000
+# Lines scored at once when estimating perplexity stats, convergence is checked after each block
+CALIBRATION_BLOCK_SIZE = 1000
+# Normal quantile of the 95% confidence intervals of perplexity stats
+CONFIDENCE_Z = 1.96
+# Number of distinct tokens whose placeholder is remembered
+PLACEHOLDER_CACHE_SIZE = 2**20
+# Order of the language model, and lowest order of a cascade model
+LM_ORDER = 7
+MIN_CASCADE_ORDER = 2
+# Data structures of KenLM binary models, only trie models can be quantized
+LM_STRUCTURES = ["probing", "trie"]
+MAX_QUANTIZE_BITS = 25
+# Ways of loading a KenLM binary model, lazy ones memory map it
+LOAD_METHODS = {
+    "lazy": kenlm.LoadMethod.LAZY,
+    "populate_or_lazy": kenlm.LoadMethod.POPULATE_OR_LAZY,
+    "populate_or_read": kenlm.LoadMethod.POPULATE_OR_READ,
+    "read": kenlm.LoadMethod.READ,
+    "parallel_read": kenlm.LoadMethod.PARALLEL_READ,
+}
+# Sentences with fewer tokens are always scored whole, walking them token by token costs more
+EARLY_EXIT_MIN_TOKENS = 64
+# Fraction of the text of those sentences scored first to decide whether to score them token by token
+EARLY_EXIT_PREFIX = 0.25
+# Tokens added at once to the sum of the ones walked, the exit is checked after each chunk
+EARLY_EXIT_CHUNK = 16
+
+
 class LMType(Enum):
     #Needed for argparse
     PLACEHOLDER='PLACEHOLDER'
@@ -42,22 +78,123 @@ class UnicodeWordClassifier:
     regexes =[ ('BASIC_LATIN',regex_basic_latin) , ('LATIN_SUPPLEMENT',regex_latin_supplement) ,  ('LATIN_EXTENDED',regex_latin_extended),
             ('ARABIC',regex_arabic), ('GREEK',regex_greek), ('CYRILIC',regex_cyrillic)]
 
+    # Unicode groups a character can belong to, as bits in the order of regexes
+    BASIC_LATIN, LATIN_SUPPLEMENT, LATIN_EXTENDED, ARABIC, GREEK, CYRILIC = (1 << i for i in range(6))
+    group_names = [name for name, _ in regexes]
+
     @classmethod
-    def classify_word(cls, word):
+    def classify_word_regex(cls, word):
+        ''' Reference implementation of classify_word, matching each regex in turn '''
         for name, r in cls.regexes:
             if r.match(word):
                 return name
         return "OTHER"
 
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def char_groups(c):
+        ''' Bit mask of the groups of a character '''
+        cls = UnicodeWordClassifier
+        code = ord(c)
+        if code < 0x80:
+            groups = cls.BASIC_LATIN | cls.LATIN_SUPPLEMENT | cls.LATIN_EXTENDED
+        elif code < 0x100:
+            groups = cls.LATIN_SUPPLEMENT | cls.LATIN_EXTENDED
+        elif code < 0x250:
+            groups = cls.LATIN_EXTENDED
+        else:
+            groups = 0
+        for bit, (_, r) in zip((cls.ARABIC, cls.GREEK, cls.CYRILIC), cls.regexes[3:]):
+            if r.match(c):
+                groups |= bit
+        return groups
+
+    @classmethod
+    def classify_word(cls, word):
+        ''' First group that contains all the characters of the word, in a single pass '''
+        if not word:
+            return "OTHER"
+        groups = -1
+        char_groups = cls.char_groups
+        for c in word:
+            groups &= char_groups(c)
+            if not groups:
+                return "OTHER"
+        # Lowest bit set is the first group in order
+        return cls.group_names[(groups & -groups).bit_length() - 1]
+
+
+class RunningStats:
+    ''' Streaming mean and standard deviation (Welford), updated with blocks of values '''
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    @staticmethod
+    def summarize(values: numpy.ndarray):
+        ''' Count, mean and sum of squared deviations of a block, to be merged '''
+        if len(values) == 0:
+            return 0, 0.0, 0.0
+        mean = float(numpy.mean(values))
+        return len(values), mean, float(numpy.sum((values - mean)**2))
+
+    def update(self, values: numpy.ndarray):
+        self.merge(*self.summarize(values))
+
+    def merge(self, n: int, mean: float, m2: float):
+        ''' Combine with the summary of another block (Chan et al.) '''
+        if n == 0:
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta**2 * self.n * n / total
+        self.n = total
+
+    @property
+    def std(self):
+        return (self.m2 / self.n)**0.5 if self.n else float("nan")
+
+    def mean_interval(self, z: float = CONFIDENCE_Z):
+        half = z * self.std / self.n**0.5 if self.n else float("nan")
+        return self.mean - half, self.mean + half
+
+    def std_interval(self, z: float = CONFIDENCE_Z):
+        # Normal approximation of the standard error of the standard deviation
+        half = z * self.std / (2 * (self.n - 1))**0.5 if self.n > 1 else float("nan")
+        return self.std - half, self.std + half
+
+    def converged(self, tolerance: float, z: float = CONFIDENCE_Z):
+        ''' True if the intervals of mean and std are within tolerance relative to their values '''
+        if self.n < 2:
+            return False
+        mean_low, mean_high = self.mean_interval(z)
+        std_low, std_high = self.std_interval(z)
+        return (mean_high - mean_low) / 2 <= tolerance * abs(self.mean) \
+                and (std_high - std_low) / 2 <= tolerance * self.std
+
 
 class LMStats:
-    def __init__(self, clean_mean: float, clean_stddev: float, noisy_mean: float, noisy_stddev: float):
+    def __init__(self, clean_mean: float, clean_stddev: float, noisy_mean: float, noisy_stddev: float,
+                 intervals: dict = None):
         self.clean_mean = clean_mean
         self.clean_stddev = clean_stddev
         self.noisy_mean = noisy_mean
         self.noisy_stddev = noisy_stddev
+        # Confidence intervals of each stat, keyed by attribute name
+        self.intervals = intervals or {}
         self._compute_limits()
 
+    @classmethod
+    def from_running(cls, clean: RunningStats, noisy: RunningStats):
+        return cls(clean.mean, clean.std, noisy.mean, noisy.std, {
+            "clean_mean": clean.mean_interval(),
+            "clean_stddev": clean.std_interval(),
+            "noisy_mean": noisy.mean_interval(),
+            "noisy_stddev": noisy.std_interval(),
+        })
+
     def _compute_limits(self):
         self.upper_limit = self.clean_mean+self.clean_stddev
         self.middle_point = self.clean_mean + (self.noisy_mean - self.clean_mean)/2
@@ -73,22 +210,51 @@ class LMStats:
         else:
             return 1 - ((perp - self.upper_limit) / (self.middle_point - self.upper_limit))*0.5
 
+    def score_floor(self):
+        ''' Perplexity below which the score is always 0, None if the upper limit is below it '''
+        # With degenerate stats the upper limit is checked first and perplexities below the lower limit can get 1
+        return self.lower_limit if self.lower_limit <= self.upper_limit else None
+
+    def perplexity_to_score_batch(self, perps: numpy.ndarray) -> numpy.ndarray:
+        ''' Vectorized version of perplexity_to_score '''
+        perps = numpy.asarray(perps, dtype=numpy.float64)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            scores = numpy.where(perps < self.middle_point,
+                    0.5 - ((perps - self.middle_point) / (self.lower_limit - self.middle_point))*0.5,
+                    1 - ((perps - self.upper_limit) / (self.middle_point - self.upper_limit))*0.5)
+        # Same precedence as perplexity_to_score, the upper limit is checked first
+        scores[perps < self.lower_limit] = 0.0
+        scores[perps > self.upper_limit] = 1.0
+        return scores
+
 
 class LMFluencyFilter:
 
-    def __init__(self, lm_type: LMType , language: str, tokenizer_command):
+    def __init__(self, lm_type: LMType , language: str, tokenizer_command, tokenizer_processes: int = 0):
         """
             lm_type: LMType
             language: language code
             tokenizer_command: tokenizer full command (with flags if needed)
+            tokenizer_processes: long-lived processes of the tokenizer command, 0 runs one per block
         """
 
         self.language = language
-        self.tokenizer = Tokenizer(tokenizer_command, self.language)
+        self.tokenizer = Tokenizer(tokenizer_command, self.language, tokenizer_processes)
         self.normalizer = MosesPunctNormalizer(lang=self.language)
         self.type = lm_type
         self.scoring_stats = None
         self.is_cjk = language in ('ja', 'zh', 'ko')
+        self.char_tokenizer = CharTokenizer(byte_level=self.is_cjk)
+        self.metrics = NULL_METRICS
+        # Stop scoring long sentences once they are certain to get score 0
+        self.early_exit = False
+        # Low-order model scoring first, see load_cascade
+        self.cascade_lm = None
+        self.cascade_stats = None
+        self.cascade_band = 0.0
+        # Sentences scored by the cascade model and the ones of them scored again by the full model,
+        # a list so that it can be shared by the filters of several languages
+        self.cascade_counts = [0, 0]
 
     @classmethod
     def _ispunctuation(cls, t):
@@ -96,6 +262,10 @@ class LMFluencyFilter:
 
     @classmethod
     def _replace_placeholder(cls, t):
+        return token_placeholder(t)
+
+    @classmethod
+    def _classify_token(cls, t):
         if t.isalpha():
             unicodeGroup = UnicodeWordClassifier.classify_word(t)
             if t.islower():
@@ -115,17 +285,82 @@ class LMFluencyFilter:
                 return "TOKEN:MIXED"
 
     @classmethod
-    def _estimate_kenlm(cls, corpus: str, lm_file: str, params: str):
-        output = subprocess.run("lmplz "+params+" < "+corpus+" > "+lm_file+".arpa", shell=True, stderr=PIPE, stdout=PIPE)
-        cls.__print_output(output)
-        output = subprocess.run("build_binary "+lm_file+".arpa "+ lm_file, shell=True, stderr=PIPE, stdout=PIPE)
-        cls.__print_output(output)
+    def _binary_params(cls, structure: str = "probing", quantize_bits: int = 0):
+        ''' build_binary options of the model data structure and quantization '''
+        params = f"-q {quantize_bits} -b {quantize_bits} " if quantize_bits else ""
+        return params + structure
 
-    def load(self, lm_path: str, stats: LMStats = None):
+    @classmethod
+    def _estimate_kenlm(cls, corpus: typing.Iterable[str], lm_file: str, params: str, pipe_arpa: bool = False,
+                        binary_params: str = "probing"):
+        '''
+        Estimate a binary KenLM model from chunks of text streamed into lmplz.
+        If pipe_arpa, the ARPA model is piped into build_binary instead of written to disk.
+        '''
+        arpa_file = lm_file + ".arpa"
+        # Logs go to temporary files, a full stderr pipe would block lmplz
+        with TemporaryFile() as lmplz_log, TemporaryFile() as binary_log:
+            arpa = PIPE if pipe_arpa else open(arpa_file, "wb")
+            lmplz = subprocess.Popen("lmplz "+params, shell=True, stdin=PIPE, stdout=arpa, stderr=lmplz_log)
+            if pipe_arpa:
+                build_binary = subprocess.Popen("build_binary "+binary_params+" /dev/stdin "+lm_file, shell=True,
+                                                stdin=lmplz.stdout, stdout=binary_log, stderr=binary_log)
+                lmplz.stdout.close()
+            else:
+                arpa.close()
+
+            try:
+                for chunk in corpus:
+                    lmplz.stdin.write(chunk.encode("utf-8"))
+                lmplz.stdin.close()
+            except BrokenPipeError:
+                # lmplz exited early, its error is printed below
+                pass
+            lmplz.wait()
+            cls.__print_output(cls.__completed(lmplz, lmplz_log))
+
+            if pipe_arpa:
+                build_binary.wait()
+                cls.__print_output(cls.__completed(build_binary, binary_log))
+            else:
+                output = subprocess.run("build_binary "+binary_params+" "+arpa_file+" "+lm_file, shell=True, stderr=PIPE, stdout=PIPE)
+                cls.__print_output(output)
+                os.remove(arpa_file)
+
+    def load(self, lm_path: str, stats: LMStats = None, lazy: bool = False, load_method: str = None):
+        """
+            lm_path: KenLM model file
+            stats: perplexity stats used to normalize scores
+            lazy: memory map the model and load its pages on demand,
+                  so processes forked after loading share the same pages
+            load_method: one of LOAD_METHODS, overrides lazy.
+                         When None, KenLM default (populate_or_read) is used
+        """
         self.lm_path = lm_path
-        self.lm = kenlm.LanguageModel(self.lm_path)
+        self.lm = kenlm.LanguageModel(self.lm_path, self._load_config(lazy, load_method))
         self.scoring_stats = stats
 
+    def load_cascade(self, lm_path: str, stats: LMStats, band: float, lazy: bool = False, load_method: str = None):
+        """
+            Low-order model scoring the sentences first. Only those whose score is
+            less than band away from 0.5 are scored again with the full model.
+            lm_path: KenLM model file
+            stats: perplexity stats of the low-order model
+            lazy, load_method: as in load
+        """
+        self.cascade_lm = kenlm.LanguageModel(lm_path, self._load_config(lazy, load_method))
+        self.cascade_stats = stats
+        self.cascade_band = band
+
+    @classmethod
+    def _load_config(cls, lazy: bool = False, load_method: str = None):
+        config = kenlm.Config()
+        if load_method is None and lazy:
+            load_method = "lazy"
+        if load_method is not None:
+            config.load_method = LOAD_METHODS[load_method]
+        return config
+
 #    def _sentence_split(self, sentence: str):
 #        return self.splitter([sentence])
 
@@ -134,60 +369,85 @@ class LMFluencyFilter:
 
         if self.type != LMType.CHARACTER:
             tokline = " ".join(self.tokenizer.tokenize(sentence))
-        elif self.is_cjk:
-            tokline = " ".join(map(str, [i for i in sentence.encode()]))
         else:
-            tokline = " ".join([ "SPACE" if c == " " else c for c in sentence  ])
+            tokline = self.char_tokenizer.tokenize(sentence)
         return tokline
 
+    def _tokenize_batch(self, sentences):
+        return self._tokenize_normalized([self.normalizer.normalize(s) for s in sentences])
+
+    def _tokenize_normalized(self, normalized):
+        if self.type == LMType.CHARACTER:
+            return self.char_tokenizer.tokenize_batch(normalized)[0]
+        # Tokenize the whole block at once, a single call for external tokenizers
+        return [" ".join(toks) for toks in self.tokenizer.tokenize(normalized)]
+
+    def _preprocess_batch(self, sentences):
+        ''' Tokenized sentences with placeholders and their number of tokens '''
+        with self.metrics.stage("normalize", len(sentences)):
+            normalized = [self.normalizer.normalize(s) for s in sentences]
+        with self.metrics.stage("tokenize", len(sentences)):
+            if self.type == LMType.CHARACTER:
+                # No placeholders, and the character tokenizer already counts the tokens
+                return self.char_tokenizer.tokenize_batch(normalized)
+            processed = [self._introduce_placeholders(tokline) for tokline in self._tokenize_normalized(normalized)]
+            return processed, [len(p.split()) for p in processed]
+
     def _introduce_placeholders(self, sentence):
         if self.type != LMType.PLACEHOLDER:
             return sentence
         else:
-            toks = self._replace_placeholder(sentence)
-            return " ".join(toks)
+            return " ".join(map(token_placeholder, sentence.split()))
 
-    def train_lm(self, text_path: str):
-        tokenized_f = NamedTemporaryFile("w", delete=False)
-        placeholderized_f = NamedTemporaryFile("w", delete=False)
-
-        #Tokenize text
-        with open(text_path) as input_f:
-            for line in input_f:
-                #line = line.rstrip("\n")
-                tokline = self._tokenize(line)
-                tokenized_f.write(tokline)
-                tokenized_f.write("\n")
-        tokenized_f.close()
-
-        #Perform placeholder replacement if needed
-        with open(tokenized_f.name) as tokenized_ff:
-            for line in tokenized_ff:
-                line = line.rstrip("\n")
-                with_placeholders = self._introduce_placeholders(line)
+    def _preprocess_training_block(self, lines):
+        ''' Tokenize and introduce placeholders in a block of training lines '''
+        processed = self._preprocess_batch(lines)[0]
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for with_placeholders in processed:
                 logging.debug("Processed training example: {}".format(with_placeholders))
-                placeholderized_f.write(with_placeholders)
-                placeholderized_f.write("\n")
-        placeholderized_f.close()
+        return "".join(with_placeholders + "\n" for with_placeholders in processed)
 
-        #Estimate LM
+    @classmethod
+    def _read_training_blocks(cls, input_f):
+        nline = 0
+        for nline, lines in read_blocks(input_f, TRAINING_BLOCK_SIZE):
+            if nline and nline % TRAINING_PROGRESS_LINES == 0:
+                logging.info(f"Training lines processed: {nline}")
+            yield lines
+            nline += len(lines)
+        logging.info(f"Training lines processed: {nline}")
+
+    def train_lm(self, text_path: str, processes: int = 1, pipe_arpa: bool = False,
+                 structure: str = "probing", quantize_bits: int = 0, order: int = LM_ORDER):
+        '''
+        Train the LM of order order streaming the preprocessed text into lmplz, without
+        temporary text files. Tokenization is done by processes forked workers.
+        The binary model uses the structure data structure, quantized to quantize_bits if not 0.
+        '''
+        global _training_filter
         lm_file = NamedTemporaryFile(delete=False)
         lm_file.close()
 
         if self.type == LMType.CHARACTER:
-            params="-o 7 --discount_fallback"
+            params=f"-o {order} --discount_fallback"
         else:
-            params="-o 7 --discount_fallback"
+            params=f"-o {order} --discount_fallback"
+        binary_params = self._binary_params(structure, quantize_bits)
 
-        self._estimate_kenlm(placeholderized_f.name, lm_file.name, params)
-        self.lm_path = lm_file.name
+        with open(text_path) as input_f:
+            blocks = self._read_training_blocks(input_f)
+            if processes == 1:
+                corpus = map(self._preprocess_training_block, blocks)
+                self._estimate_kenlm(corpus, lm_file.name, params, pipe_arpa, binary_params)
+            else:
+                _training_filter = self
+                with multiprocessing.get_context("fork").Pool(processes) as pool:
+                    corpus = imap_bounded(pool, _preprocess_training_block, blocks, 2 * processes)
+                    self._estimate_kenlm(corpus, lm_file.name, params, pipe_arpa, binary_params)
 
+        self.lm_path = lm_file.name
         self.lm = kenlm.LanguageModel(self.lm_path)
 
-        #Remove temporary files
-        os.remove(tokenized_f.name) 
-        os.remove(placeholderized_f.name)
-
     def copy_lm(self, dst: str):
         shutil.copyfile(self.lm_path, dst)
 
@@ -197,6 +457,12 @@ class LMFluencyFilter:
     def _raw_score(self, sentence: str):
         return self.lm.score(sentence)
 
+    @classmethod
+    def __completed(cls, process, log_f):
+        ''' CompletedProcess of a finished process whose output was written to log_f '''
+        log_f.seek(0)
+        return subprocess.CompletedProcess(process.args, process.returncode, b'', log_f.read())
+
     @classmethod
     def __print_output(cls, output):
         if output.returncode != 0:
@@ -207,13 +473,50 @@ class LMFluencyFilter:
             logging.debug(output.stderr.decode())
             logging.debug(output.stdout.decode())
 
-    def estimate_threshold(self, dev_corpus: str):
-        scores=[]
+    def estimate_threshold(self, dev_corpus: str, block_size: int = 10000):
+        stats = RunningStats()
         with open(dev_corpus) as corpus_f:
-            for line in corpus_f:
-                line = line.rstrip("\n")
-                scores.append(self.raw_score(line))
-        return numpy.mean(scores),numpy.std(scores)
+            for _, lines in read_blocks(corpus_f, block_size):
+                stats.update(self.raw_score_batch([line.rstrip("\n") for line in lines]))
+        return stats.mean, stats.std
+
+    def _score_calibration_block(self, task):
+        name, lines = task
+        return name, RunningStats.summarize(self.raw_score_batch(lines))
+
+    def estimate_stats(self, clean: str, noisy: str, processes: int = 1, tolerance: float = 0.0,
+                       block_size: int = CALIBRATION_BLOCK_SIZE) -> LMStats:
+        '''
+        Perplexity stats of clean and noisy dev sets, scored once in parallel by
+        processes forked workers. If tolerance, a set stops being scored when the
+        confidence intervals of its mean and std are within tolerance relative to them.
+        '''
+        global _training_filter
+        running = {"clean": RunningStats(), "noisy": RunningStats()}
+
+        def blocks():
+            with open(clean) as clean_f, open(noisy) as noisy_f:
+                # Alternate blocks of both sets so they converge at the same pace
+                readers = {"clean": read_blocks(clean_f, block_size), "noisy": read_blocks(noisy_f, block_size)}
+                while readers:
+                    for name in list(readers):
+                        block = next(readers[name], None)
+                        if block is None or (tolerance and running[name].converged(tolerance)):
+                            del readers[name]
+                            continue
+                        yield name, [line.rstrip("\n") for line in block[1]]
+
+        if processes == 1:
+            for name, summary in map(self._score_calibration_block, blocks()):
+                running[name].merge(*summary)
+        else:
+            _training_filter = self
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                for name, summary in imap_bounded(pool, _score_calibration_block, blocks(), 2 * processes):
+                    running[name].merge(*summary)
+
+        logging.info(f"Perplexity stats estimated on {running['clean'].n} clean and {running['noisy'].n} noisy lines")
+        return LMStats.from_running(running["clean"], running["noisy"])
 
     def raw_score(self, sentence: str):
         #We need to preprocess the sentence in the same way as when training the LM
@@ -228,10 +531,103 @@ class LMFluencyFilter:
         #return sum(raw_scores)/(sum([len(s.split()) for s in processed_sents]) + len(processed_sents) ) # We divide by total number of tokens + 1 for each sentence (taken from kenlm perplexity method)
         return raw_score/(sum([len(processed_sent.split())]) +1) #the same, but assuming only 1 sentence
 
+    def _bounded_score(self, sentence: str, length: int, floor: float):
+        '''
+        KenLM score of a sentence of length tokens, or -inf as soon as its
+        perplexity is certain to be below floor
+        '''
+        # Log-probs are never positive, the rest of the sentence can only lower the perplexity.
+        # Sentences whose prefix isn't below floor on average are unlikely to end below it, they are scored whole
+        cut = sentence.find(" ", int(len(sentence) * EARLY_EXIT_PREFIX))
+        if cut == -1:
+            return self.lm.score(sentence)
+        prefix_score = self.lm.score(sentence[:cut], bos=True, eos=False)
+        if prefix_score / length < floor:
+            return float("-inf")
+        if prefix_score / (sentence.count(" ", 0, cut) + 1) >= floor:
+            return self.lm.score(sentence)
+
+        # The sum is kept in float32, as KenLM adds them when scoring whole sentences.
+        # Log-probs are added to it in chunks, cumsum adds them one by one in order
+        total = numpy.float32(0.0)
+        chunk = [total]
+        for prob, _, _ in self.lm.full_scores(sentence):
+            chunk.append(prob)
+            if len(chunk) > EARLY_EXIT_CHUNK:
+                total = numpy.cumsum(numpy.array(chunk, dtype=numpy.float32))[-1]
+                if float(total) / length < floor:
+                    return float("-inf")
+                chunk = [total]
+        return float(numpy.cumsum(numpy.array(chunk, dtype=numpy.float32))[-1])
+
+    def raw_score_batch(self, sentences: typing.List[str], floor: float = None) -> numpy.ndarray:
+        '''
+        Same as raw_score for a block of sentences.
+        If floor is given, long sentences whose perplexity is certain to be below it
+        are not scored whole and get -inf.
+        '''
+        if not sentences:
+            return numpy.empty(0)
+        processed_sents, counts = self._preprocess_batch(sentences)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for processed_sent in processed_sents:
+                logging.debug("Scoring: {}".format(processed_sent))
+
+        with self.metrics.stage("kenlm", len(processed_sents)):
+            scores = self._kenlm_scores(processed_sents, counts, floor)
+        return scores / (numpy.array(counts, dtype=numpy.float64) + 1)
+
+    def _kenlm_scores(self, processed_sents, counts, floor=None):
+        ''' KenLM scores of preprocessed sentences with counts tokens, -inf for the ones certain to be below floor '''
+        if floor is None:
+            return numpy.fromiter(map(self.lm.score, processed_sents), dtype=numpy.float64, count=len(processed_sents))
+        return numpy.fromiter((self.lm.score(s) if n + 1 < EARLY_EXIT_MIN_TOKENS else self._bounded_score(s, n + 1, floor)
+                               for s, n in zip(processed_sents, counts)), dtype=numpy.float64, count=len(processed_sents))
+
     def score(self, sentence: str):
         return self.scoring_stats.perplexity_to_score(self.raw_score(sentence))
 
-    def train(self, lm_train: str, clean: str, noisy: str, lm_out: str) -> LMStats:
+    def score_batch(self, sentences: typing.List[str]) -> numpy.ndarray:
+        if self.cascade_lm is not None:
+            return self.cascade_score_batch(sentences)
+        # Perplexities below the floor get score 0 whatever their value
+        floor = self.scoring_stats.score_floor() if self.early_exit else None
+        return self.scoring_stats.perplexity_to_score_batch(self.raw_score_batch(sentences, floor))
+
+    def cascade_scores(self, sentences: typing.List[str]):
+        '''
+        Scores of the low-order model and preprocessed sentences and token counts,
+        to score some of them again with the full model
+        '''
+        processed_sents, counts = self._preprocess_batch(sentences)
+        with self.metrics.stage("kenlm_cascade", len(processed_sents)):
+            perps = numpy.fromiter(map(self.cascade_lm.score, processed_sents), dtype=numpy.float64, count=len(processed_sents))
+        perps /= numpy.array(counts, dtype=numpy.float64) + 1
+        return self.cascade_stats.perplexity_to_score_batch(perps), processed_sents, counts
+
+    def cascade_score_batch(self, sentences: typing.List[str], band: float = None) -> numpy.ndarray:
+        '''
+        Score with the low-order model, and again with the full model the sentences
+        whose score is less than band (cascade_band by default) away from 0.5
+        '''
+        if not sentences:
+            return numpy.empty(0)
+        band = self.cascade_band if band is None else band
+        scores, processed_sents, counts = self.cascade_scores(sentences)
+        escalated = numpy.flatnonzero(numpy.abs(scores - 0.5) < band)
+        self.cascade_counts[0] += len(scores)
+        self.cascade_counts[1] += len(escalated)
+        if len(escalated):
+            escalated_counts = [counts[i] for i in escalated]
+            floor = self.scoring_stats.score_floor() if self.early_exit else None
+            with self.metrics.stage("kenlm", len(escalated)):
+                perps = self._kenlm_scores([processed_sents[i] for i in escalated], escalated_counts, floor)
+            perps /= numpy.array(escalated_counts, dtype=numpy.float64) + 1
+            scores[escalated] = self.scoring_stats.perplexity_to_score_batch(perps)
+        return scores
+
+    def train(self, lm_train: str, clean: str, noisy: str, lm_out: str, processes: int = 1, pipe_arpa: bool = False,
+              tolerance: float = 0.0, structure: str = "probing", quantize_bits: int = 0, order: int = LM_ORDER) -> LMStats:
         # Check that KenLM is correctly installed
         output = subprocess.run("lmplz", shell=True, stderr=PIPE, stdout=PIPE)
         if output.returncode == 127:
@@ -241,10 +637,8 @@ class LMFluencyFilter:
             raise SystemExit()
 
         try:
-            self.train_lm(lm_train)
-            clean_mean, clean_stddev = self.estimate_threshold(clean)
-            noisy_mean, noisy_stddev = self.estimate_threshold(noisy)
-            self.scoring_stats = LMStats(clean_mean, clean_stddev, noisy_mean, noisy_stddev)
+            self.train_lm(lm_train, processes, pipe_arpa, structure, quantize_bits, order)
+            self.scoring_stats = self.estimate_stats(clean, noisy, processes, tolerance)
             self.copy_lm(lm_out)
         finally:
             self.cleanup()
@@ -252,24 +646,42 @@ class LMFluencyFilter:
         return self.scoring_stats
 
 
-def shuffle_lm_training(input: typing.TextIO, dev_size: int ) -> (str,str,str,str):
-    dev = NamedTemporaryFile("w", delete=False)
-    train = NamedTemporaryFile("w", delete=False)
+# Placeholder of each token, memoized because the same tokens are seen over and over.
+# Shared by training and scoring so that both replace tokens the same way
+token_placeholder = lru_cache(maxsize=PLACEHOLDER_CACHE_SIZE)(LMFluencyFilter._classify_token)
 
-    logging.debug("Shuffling and creating dev set")
-    with TemporaryFile("w+") as shuf:
-        #Shuffle the independent files
-        shuffle_file(input, shuf)
+# Fluency filter being trained, inherited by the forked tokenization workers
+_training_filter = None
 
-        #read them and split between dev and train
-        shuf.seek(0)
+def _preprocess_training_block(lines):
+    return _training_filter._preprocess_training_block(lines)
 
-        for i in range(dev_size):
-            line = shuf.readline()
-            dev.write(line)
+def _score_calibration_block(task):
+    return _training_filter._score_calibration_block(task)
+
+# Split input into train and dev files. The dev set is a reservoir sample of
+# dev_size lines, so the rest can be streamed to the train file in bounded memory.
+# The LM doesn't depend on the order of the training lines, so they are not shuffled.
+def shuffle_lm_training(input: typing.TextIO, dev_size: int) -> (str,str):
+    dev = NamedTemporaryFile("w", delete=False)
+    train = NamedTemporaryFile("w", delete=False)
 
-        for line in shuf:
-            train.write(line)
+    logging.debug("Sampling dev set")
+    reservoir = []
+    for i, line in enumerate(input):
+        if not line.endswith("\n"):
+            line += "\n"
+        if i < dev_size:
+            reservoir.append(line)
+            continue
+        # Keep each line in the dev set with probability dev_size/(i+1)
+        j = random.randrange(i + 1)
+        if j < dev_size:
+            reservoir[j], line = line, reservoir[j]
+        train.write(line)
+
+    random.shuffle(reservoir)
+    dev.writelines(reservoir)
 
     dev.close()
     train.close()
@@ -356,9 +768,7 @@ if __name__ == "__main__":
             ff = LMFluencyFilter(args.lm_type, args.language, args.tokenizer_command)
             ff.load(args.lm_file)
 
-        clean_mean, clean_stddev = ff.estimate_threshold(dev_file)
-        noisy_mean, noisy_stddev = ff.estimate_threshold(dev_noisy)
-        stats = LMStats(clean_mean, clean_stddev, noisy_mean, noisy_stddev)
+        stats = ff.estimate_stats(dev_file, dev_noisy)
 
         with open(args.corpus) as corpus_f:
             for i, line in enumerate(corpus_f):
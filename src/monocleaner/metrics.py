@@ -0,0 +1,196 @@
+from contextlib import contextmanager, nullcontext
+from timeit import default_timer
+from collections import Counter
+import logging
+import json
+import os
+
+try:
+    from .util import check_positive
+except (SystemError, ImportError):
+    from util import check_positive
+
+
+def add_metrics_arguments(parser):
+    ''' Profiling options of the scoring commands '''
+    parser.add_argument("--profile", action='store_true', help="Record time and calls of each stage and hardrule, tags and line counts, and log a summary at the end")
+    parser.add_argument("--metrics_file", type=str, help="File where the profiling metrics are written at the end and periodically. Enables --profile")
+    parser.add_argument("--metrics_format", default="json", choices=["json", "prometheus"], help="Format of the metrics file")
+    parser.add_argument("--metrics_interval", default=60, type=check_positive, help="Seconds between writes of the metrics file during the run")
+
+def create_metrics(args):
+    ''' Metrics requested by the profiling options, a no-op if they are disabled '''
+    if not args.profile and not args.metrics_file:
+        return NULL_METRICS
+    return Metrics(args.metrics_file, args.metrics_format, args.metrics_interval)
+
+
+class Metrics():
+    '''
+    Time and calls of each scoring stage, runs, discards and time of each
+    hardrule, tag counts and input and output lines.
+    Stages are timed once per block, rules once per sentence.
+    '''
+    enabled = True
+
+    def __init__(self, path=None, format="json", interval=60):
+        self.path = path
+        self.format = format
+        self.interval = interval
+        self.time_start = default_timer()
+        self.last_write = self.time_start
+        self.stages = {} # calls, sentences, time
+        self.rules = {} # runs, discarded, time
+        self.tags = Counter()
+        self.input_lines = 0
+        self.output_lines = 0
+
+    @contextmanager
+    def stage(self, name, sentences):
+        time_start = default_timer()
+        try:
+            yield
+        finally:
+            stats = self.stages.setdefault(name, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += sentences
+            stats[2] += default_timer() - time_start
+
+    def timed_rule(self, name, rule):
+        ''' Wrap a hardrule to count its runs, discards and time '''
+        stats = self.rules.setdefault(name, [0, 0, 0.0])
+        def timed(sentence):
+            time_start = default_timer()
+            result = rule(sentence)
+            stats[2] += default_timer() - time_start
+            stats[0] += 1
+            if not result:
+                stats[1] += 1
+            return result
+        return timed
+
+    def count_lines(self, input_lines, output_lines):
+        self.input_lines += input_lines
+        self.output_lines += output_lines
+
+    def count_tags(self, tags):
+        self.tags.update(tags)
+
+    def pop(self):
+        ''' Return the counts and reset them, to be merged into the metrics of another process '''
+        counts = {"stages": {n: list(s) for n, s in self.stages.items()},
+                  "rules": {n: list(s) for n, s in self.rules.items()},
+                  "tags": dict(self.tags),
+                  "lines": (self.input_lines, self.output_lines)}
+        # Reset in place, timed rules keep a reference to their stats
+        for stats in list(self.stages.values()) + list(self.rules.values()):
+            stats[:] = [0, 0, 0.0]
+        self.tags.clear()
+        self.input_lines = self.output_lines = 0
+        return counts
+
+    def merge(self, counts):
+        for table, merged in ((self.stages, counts["stages"]), (self.rules, counts["rules"])):
+            for name, values in merged.items():
+                stats = table.setdefault(name, [0, 0, 0.0])
+                for i, value in enumerate(values):
+                    stats[i] += value
+        self.tags.update(counts["tags"])
+        self.count_lines(*counts["lines"])
+
+    def as_dict(self):
+        return {
+            "elapsed_seconds": default_timer() - self.time_start,
+            "input_lines": self.input_lines,
+            "output_lines": self.output_lines,
+            "stages": {n: {"calls": c, "sentences": s, "seconds": t} for n, (c, s, t) in self.stages.items()},
+            "rules": {n: {"runs": r, "discarded": d, "seconds": t} for n, (r, d, t) in sorted(self.rules.items())},
+            "tags": dict(self.tags.most_common()),
+        }
+
+    def as_prometheus(self):
+        ''' Metrics in Prometheus text exposition format '''
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        metrics = self.as_dict()
+        lines = []
+        def add(name, kind, help, samples):
+            lines.append(f"# HELP monocleaner_{name} {help}")
+            lines.append(f"# TYPE monocleaner_{name} {kind}")
+            for labels, value in samples:
+                labels = ",".join(f'{k}="{label(v)}"' for k, v in labels.items())
+                lines.append(f"monocleaner_{name}{{{labels}}} {value}" if labels else f"monocleaner_{name} {value}")
+
+        add("elapsed_seconds", "gauge", "Seconds since scoring started.", [({}, metrics["elapsed_seconds"])])
+        add("input_lines_total", "counter", "Input lines read.", [({}, metrics["input_lines"])])
+        add("output_lines_total", "counter", "Output lines written.", [({}, metrics["output_lines"])])
+        for key, help in (("calls", "Blocks processed by each stage."),
+                          ("sentences", "Sentences processed by each stage."),
+                          ("seconds", "Seconds spent in each stage.")):
+            add(f"stage_{key}_total", "counter", help, [({"stage": n}, s[key]) for n, s in metrics["stages"].items()])
+        for key, help in (("runs", "Sentences checked by each hardrule."),
+                          ("discarded", "Sentences discarded by each hardrule."),
+                          ("seconds", "Seconds spent in each hardrule.")):
+            add(f"rule_{key}_total", "counter", help, [({"rule": n}, s[key]) for n, s in metrics["rules"].items()])
+        add("tag_total", "counter", "Output lines with each hardrules tag.", [({"tag": t}, c) for t, c in metrics["tags"].items()])
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        ''' Write the metrics file, replacing it at once so that readers never see it half written '''
+        self.last_write = default_timer()
+        if not self.path:
+            return
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file_:
+            if self.format == "prometheus":
+                file_.write(self.as_prometheus())
+            else:
+                json.dump(self.as_dict(), file_, indent=2)
+                file_.write("\n")
+        os.replace(temp_path, self.path)
+
+    def checkpoint(self):
+        ''' Write the metrics file if the interval has passed since the last write '''
+        if self.path and default_timer() - self.last_write >= self.interval:
+            self.write()
+
+    def close(self):
+        self.write()
+        metrics = self.as_dict()
+        logging.info(f"Profile: {metrics['input_lines']} input lines, {metrics['output_lines']} output lines")
+        for name, stats in metrics["stages"].items():
+            logging.info(f"Profile stage {name}: {stats['seconds']:.3f} s, {stats['sentences']} sentences in {stats['calls']} calls")
+        for name, stats in sorted(metrics["rules"].items(), key=lambda r: -r[1]["seconds"]):
+            logging.info(f"Profile rule {name}: {stats['seconds']:.3f} s, {stats['discarded']} discarded of {stats['runs']}")
+        for tag, count in metrics["tags"].items():
+            logging.info(f"Profile tag {tag}: {count}")
+
+
+class NullMetrics():
+    ''' Metrics that record nothing, used when profiling is disabled '''
+    enabled = False
+
+    def stage(self, name, sentences):
+        return nullcontext()
+
+    def count_lines(self, input_lines, output_lines):
+        pass
+
+    def count_tags(self, tags):
+        pass
+
+    def pop(self):
+        return None
+
+    def merge(self, counts):
+        pass
+
+    def checkpoint(self):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
@@ -1,7 +1,11 @@
 from argparse import ArgumentParser
 from timeit import default_timer
+from itertools import islice
+from functools import partial
 from fastspell import FastSpell
+import multiprocessing
 import logging
+import copy
 import yaml
 import sys
 import os
@@ -9,20 +13,35 @@ import os
 try:
     from . import __version__
     from .lm import *
-    from .util import logging_setup, check_if_folder, check_positive
-    from .hardrules import Hardrules
+    from .util import logging_setup, check_if_folder, check_positive, check_positive_or_zero, \
+        check_positive_or_zero_float, check_positive_between_zero_and_one, imap_bounded, read_blocks_async, \
+        AsyncWriter
+    from .hardrules import Hardrules, ScoringPipeline
+    from .registry import ModelRegistry, MultilingualPipeline, find_model_packs
+    from .cache import ScoreCache
+    from .metrics import NULL_METRICS, add_metrics_arguments, create_metrics
+    from .checkpoint import add_checkpoint_arguments, read_checkpoint, create_checkpoint
+    from .formats import SCORE_FIELD, LANG_FIELD, TAG_FIELD, add_format_arguments, open_input, open_output
 except (SystemError, ImportError):
     from monocleaner import __version__
     from lm import *
-    from util import logging_setup, check_if_folder, check_positive
-    from hardrules import Hardrules
+    from util import logging_setup, check_if_folder, check_positive, check_positive_or_zero, \
+        check_positive_or_zero_float, check_positive_between_zero_and_one, imap_bounded, read_blocks_async, \
+        AsyncWriter
+    from hardrules import Hardrules, ScoringPipeline
+    from registry import ModelRegistry, MultilingualPipeline, find_model_packs
+    from cache import ScoreCache
+    from metrics import NULL_METRICS, add_metrics_arguments, create_metrics
+    from checkpoint import add_checkpoint_arguments, read_checkpoint, create_checkpoint
+    from formats import SCORE_FIELD, LANG_FIELD, TAG_FIELD, add_format_arguments, open_input, open_output
 
-def initialization():
+def argument_parser():
+    ''' Parser of the model and scoring arguments, shared with monocleaner-server '''
     parser = ArgumentParser()
-    parser.add_argument("model_dir", type=check_if_folder, help="Model directory to store LM file and metadata.")
-    parser.add_argument("input", type=argparse.FileType('r'), nargs='?', help="Input file. If omitted, read from 'stdin'.")
-    parser.add_argument("output", type=argparse.FileType('w'), nargs='?', help="Output tab-separated text file adding monocleaner score. When omitted output will be written to stdout.")
+    parser.add_argument("model_dir", type=check_if_folder, help="Model directory to store LM file and metadata. With --lang_col, directory with a model pack of each language.")
     parser.add_argument("--scol", default=1, type=check_positive, help ="Sentence column (starting in 1)")
+    parser.add_argument("--lang_col", type=check_positive, help="Language column (starting in 1), e.g. the output of a language identifier. Each sentence is scored with the model pack of its language in model_dir")
+    parser.add_argument("--models_memory", default=0, type=check_positive_or_zero, help="MB of KenLM models kept loaded by each process with --lang_col. The least recently used ones are unloaded above it. 0 keeps all of them")
     parser.add_argument("--disable_lang_ident", action='store_true', help="Disables language identification in hardrules")
     parser.add_argument("--disable_hardrules", action='store_true', help='Disables the hardrules filtering (only monocleaner fluency scoring is applied)')
     parser.add_argument("--disable_minimal_length", action='store_true', help="Don't apply minimal length (3 words) rule")
@@ -32,18 +51,52 @@ def initialization():
     parser.add_argument("--detect_script", action='store_true', help="Detect writing script with FastSpell (only Serbo-Croatian is supported)")
     parser.add_argument("--annotated_output", action='store_true', help="Add hardrules annotation for each sentence")
     parser.add_argument("--run_all_rules", action='store_true', help="Run all hardrules for each sentence instead of stopping at the first one discarded")
+    parser.add_argument("--rules_warmup", default=1000, type=check_positive_or_zero, help="Number of sentences used to measure hardrules cost and discard rate before scheduling them. 0 runs them always in report order")
+    parser.add_argument("--rules_profile", type=str, help="File with hardrules cost and discard stats. If it exists, rules are scheduled with them and warm-up is skipped, otherwise warm-up stats are saved to it")
+    parser.add_argument("--rules_timeout", default=0, type=check_positive_or_zero_float, help="Seconds each hardrule can spend on a sentence. Sentences a rule runs out of time on are discarded with the rule tag followed by '_timeout'. 0 disables it")
+    parser.add_argument("--cache_size", default=0, type=check_positive_or_zero, help="Number of scored sentences kept in memory to reuse the result of repeated sentences. 0 disables it")
+    parser.add_argument("--cache_file", type=str, help="dbm file where results are stored to reuse them across runs. Only with 1 process")
+    parser.add_argument("-p", "--processes", default=1, type=check_positive, help="Number of worker processes used for scoring. Workers share the same memory mapped model")
+    parser.add_argument("--block_size", default=10000, type=check_positive, help="Number of lines read and sent to a worker at once")
+    parser.add_argument("--tokenizer_processes", default=0, type=check_positive_or_zero, help="Long-lived processes of the model tokenizer command, fed with whole blocks. It must write each line as soon as it is read. 0 runs a new process for each block")
+    parser.add_argument("--load_method", choices=list(LOAD_METHODS), help="How the model is loaded. When omitted, the one recorded at training is used, or lazy with several processes")
+    parser.add_argument("--cascade_band", type=check_positive_between_zero_and_one, help="With a model trained with a cascade model, sentences whose cascade score is less than this away from 0.5 are scored with the full model, up to 0.5. When omitted, the one recorded at training is used")
+    parser.add_argument("--disable_cascade", action='store_true', help="Score all sentences with the full model even if the model has a cascade model")
+    parser.add_argument("--lm_early_exit", action='store_true', help="Score long sentences token by token, stopping as soon as they are certain to get score 0. Scores don't change. It only pays off when model lookups are slow, like large models loaded lazily, and many long sentences are very noisy")
     parser.add_argument("--debug", action='store_true')
     parser.add_argument("-q", "--quiet", action='store_true')
     parser.add_argument('-v', '--version', action='version', version="%(prog)s " + __version__, help="show version of this script and exit")
+    # Only files are read in other formats than tab-separated text
+    parser.set_defaults(record_format=None, lang_field=None)
+
+    return parser
+
+def initialization():
+    parser = argument_parser()
+    parser.add_argument("input", type=str, nargs='?', help="Input file, .gz, .xz and .zst are decompressed. If omitted, read from 'stdin'.")
+    parser.add_argument("output", type=str, nargs='?', help="Output file in the input format adding monocleaner score, .gz, .xz and .zst are compressed. When omitted output will be written to stdout.")
+    add_format_arguments(parser, lang_field=True)
+    add_metrics_arguments(parser)
+    add_checkpoint_arguments(parser)
 
     args = parser.parse_args()
 
+    # The output is opened once the checkpoint is read, a resumed run keeps what was written
+    logging_setup(args)
+    args.checkpoint_state = read_checkpoint(args)
+    if args.checkpoint and args.format == "parquet":
+        logging.error("--checkpoint needs a text output, it can't be used with parquet format")
+        sys.exit(1)
+    open_input(args, parser)
+    open_output(args, parser, 'r+' if args.checkpoint_state else 'w')
+
+    setup(args)
+    return args
+
+def setup(args):
+    ''' Check arguments, set up logging and load the model '''
     args.metadata = args.model_dir + '/metadata.yaml'
-    if args.output == None:
-        args.output = sys.stdout
-    if args.input == None:
-        args.input = sys.stdin
-        
+
     # Language identification sanity checks
     if args.disable_lang_ident:
         args.add_lang_ident = False
@@ -52,9 +105,30 @@ def initialization():
             args.disable_lang_ident = False
 
     logging_setup(args)
-    load_model(args)
+    if args.cascade_band is not None and args.cascade_band > 0.5:
+        logging.error("--cascade_band can't be above 0.5")
+        sys.exit(1)
+    if args.cache_file and args.processes > 1:
+        logging.error("--cache_file can't be written by several processes, use --processes 1")
+        sys.exit(1)
+
+    # Counts of the cascade models of all the languages
+    args.cascade_counts = [0, 0]
+    if args.lang_col or args.lang_field:
+        # Models are loaded on first use of each language
+        if args.cache_size or args.cache_file:
+            logging.error("--cache_size and --cache_file can't be used with --lang_col or --lang_field")
+            sys.exit(1)
+        args.packs = find_model_packs(args.model_dir)
+        if not args.packs:
+            logging.error(f"No model packs found in {args.model_dir}")
+            sys.exit(1)
+        logging.info(f"Model packs found: {' '.join(args.packs)}")
+        args.cache = None
+    else:
+        load_model(args)
+        load_cache(args)
     logging.debug(args)
-    return args
 
 def load_model(args):
     with open(args.metadata) as file_:
@@ -68,12 +142,26 @@ def load_model(args):
         else:
             args.tokenizer_command = None
 
-        args.ff = LMFluencyFilter(args.lm_type, args.language, args.tokenizer_command)
+        args.ff = LMFluencyFilter(args.lm_type, args.language, args.tokenizer_command, args.tokenizer_processes)
         stats = LMStats(metadata["clean_mean_perp"],
                         metadata["clean_stddev_perp"],
                         metadata["noisy_mean_perp"],
                         metadata["noisy_stddev_perp"])
-        args.ff.load(args.lm_file, stats)
+        # Load the model lazily when it is going to be shared by several workers,
+        # unless another load method is requested or was chosen at training
+        load_method = args.load_method or metadata.get("load_method")
+        args.ff.load(args.lm_file, stats, lazy=args.processes > 1, load_method=load_method)
+        args.ff.early_exit = args.lm_early_exit
+        args.ff.cascade_counts = args.cascade_counts
+        # Clear-cut sentences are scored by the low-order model alone
+        if "cascade_lm_file" in metadata and not args.disable_cascade:
+            cascade_stats = LMStats(metadata["cascade_clean_mean_perp"],
+                                    metadata["cascade_clean_stddev_perp"],
+                                    metadata["cascade_noisy_mean_perp"],
+                                    metadata["cascade_noisy_stddev_perp"])
+            band = metadata["cascade_band"] if args.cascade_band is None else args.cascade_band
+            args.ff.load_cascade(args.model_dir + '/' + metadata["cascade_lm_file"], cascade_stats, band,
+                                 lazy=args.processes > 1, load_method=load_method)
 
         if args.disable_lang_ident:
             args.fastspell = None
@@ -82,74 +170,221 @@ def load_model(args):
                                        hbs=not args.disable_hbs,
                                        script=args.detect_script)
 
+def create_pipeline(args, metrics=NULL_METRICS):
+    ''' Hardrules, language identification and fluency scoring stages '''
+    if args.lang_col or args.lang_field:
+        registry = ModelRegistry(args.packs, partial(load_language, args, metrics), args.models_memory * 2**20)
+        return MultilingualPipeline(registry, metrics)
+    return ScoringPipeline(args, Hardrules(args), args.ff, langid_discarded=args.add_lang_ident, metrics=metrics)
+
+def load_language(args, metrics, language, model_dir):
+    ''' Pipeline of the model pack of a language, with the same options '''
+    lang_args = copy.copy(args)
+    lang_args.model_dir = model_dir
+    lang_args.metadata = os.path.join(model_dir, 'metadata.yaml')
+    if args.rules_profile:
+        lang_args.rules_profile = f"{args.rules_profile}.{language}"
+    load_model(lang_args)
+    return ScoringPipeline(lang_args, Hardrules(lang_args), lang_args.ff, langid_discarded=args.add_lang_ident, metrics=metrics)
+
+def score_sentences(args, pipeline, sentences, languages=None):
+    ''' Return score, identified language and hardrules tag of each sentence in a block '''
+    if languages is not None:
+        return pipeline.process(sentences, languages)
+    if args.cache is None:
+        return pipeline.process(sentences)
+
+    # Only score the distinct sentences that are not cached
+    results = {sentence: args.cache.get(sentence) for sentence in dict.fromkeys(sentences)}
+    missing = [sentence for sentence, result in results.items() if result is None]
+    for sentence, result in zip(missing, pipeline.process(missing)):
+        results[sentence] = result
+        args.cache.put(sentence, result)
+    # Repetitions inside the block are hits too
+    args.cache.hits += len(sentences) - len(results)
+
+    return [results[sentence] for sentence in sentences]
+
+def format_output(args, line, score, langid, tag):
+    ''' Build the output line of a scored input line '''
+    # print sentence when no score_only
+    # always print score
+    # print identified language if requested
+    # print hardrule annotation if requested
+    fields = []
+    if not args.score_only:
+        fields.append(line)
+    if tag != "keep":
+        fields.append(f"{score}")
+    else:
+        fields.append(f"{score:.3f}")
+    if args.add_lang_ident:
+        fields.append(langid)
+    if args.annotated_output:
+        fields.append(tag)
+    return '\t'.join(fields) + '\n'
+
+def output_fields(args, results):
+    ''' Names and values of the fields added to JSONL and Parquet records '''
+    fields = [(SCORE_FIELD, [float(round(score, 3) if tag == "keep" else score) for score, _, tag in results])]
+    if args.add_lang_ident:
+        fields.append((LANG_FIELD, [langid for _, langid, _ in results]))
+    if args.annotated_output:
+        fields.append((TAG_FIELD, [tag for _, _, tag in results]))
+    return fields
+
+def process_records(args, pipeline, block, nline):
+    ''' Score a block of JSONL or Parquet records, nline being the number of records before it '''
+    record_format = args.record_format
+    records, sentences, languages = record_format.parse(block, nline)
+    valid = [i for i, sentence in enumerate(sentences) if sentence is not None]
+    if len(valid) < len(sentences):
+        # Records without sentence or language are kept in place, discarded
+        results = [(0, args.language if languages is None else languages[i], "missing_columns") for i in range(len(sentences))]
+        valid_results = score_sentences(args, pipeline, [sentences[i] for i in valid],
+                                        None if languages is None else [languages[i] for i in valid])
+        for i, result in zip(valid, valid_results):
+            results[i] = result
+    else:
+        results = score_sentences(args, pipeline, sentences, languages)
+    with pipeline.metrics.stage("format", len(results)):
+        output = record_format.format(records, output_fields(args, results), args.score_only)
+    pipeline.metrics.count_lines(len(block), len(results))
+    pipeline.metrics.count_tags(tag for _, _, tag in results)
+    return output
+
+def process_block(args, pipeline, lines, nline):
+    ''' Score a block of input lines, nline being the number of lines before it '''
+    if args.record_format is not None:
+        return process_records(args, pipeline, lines, nline)
+    valid_lines = []
+    sentences = []
+    languages = [] if args.lang_col else None
+    columns = max(args.scol, args.lang_col or 0)
+    for line in lines:
+        nline += 1
+        line = line.rstrip("\n")
+        parts = line.split("\t")
+
+        if len(parts) >= columns:
+            valid_lines.append(line)
+            sentences.append(parts[args.scol-1])
+            if languages is not None:
+                languages.append(parts[args.lang_col-1].strip())
+        elif len(parts) < args.scol:
+            logging.error(f" scol ({args.scol}) index above column number ({len(parts)}) on line {nline}")
+        else:
+            logging.error(f" lang_col ({args.lang_col}) index above column number ({len(parts)}) on line {nline}")
+
+    results = score_sentences(args, pipeline, sentences, languages)
+    with pipeline.metrics.stage("format", len(results)):
+        output = ''.join(format_output(args, line, *result) for line, result in zip(valid_lines, results))
+    pipeline.metrics.count_lines(len(lines), len(results))
+    pipeline.metrics.count_tags(tag for _, _, tag in results)
+    return output
+
+# Scoring state inherited by the forked worker processes
+_worker_args = None
+_worker_pipeline = None
+
+def _init_worker():
+    # Forget the metrics of the blocks scored in the parent before forking
+    _worker_pipeline.metrics.pop()
+
+def _process_block_worker(block):
+    nline, lines = block
+    time_start = default_timer()
+    cache = _worker_args.cache
+    if cache is not None:
+        hits, misses = cache.hits, cache.misses
+    cascade_counts = list(_worker_args.cascade_counts)
+    output = process_block(_worker_args, _worker_pipeline, lines, nline)
+    if cache is not None:
+        # Report the cache counts of the block so they are added up in the parent
+        hits, misses = cache.hits - hits, cache.misses - misses
+    else:
+        hits, misses = 0, 0
+    cascade_counts = [after - before for after, before in zip(_worker_args.cascade_counts, cascade_counts)]
+    metrics = _worker_pipeline.metrics.pop()
+    return output, os.getpid(), len(lines), default_timer() - time_start, hits, misses, cascade_counts, metrics
+
+def load_cache(args):
+    ''' Create the cache of results for the loaded model and current options '''
+    if not args.cache_size and not args.cache_file:
+        args.cache = None
+        return
+
+    # Results depend on the model and on the options that change tags or langid
+    with open(args.metadata) as file_:
+        identity = file_.read()
+    options = ["disable_lang_ident", "disable_hardrules", "disable_minimal_length", "disable_hbs",
+               "detect_script", "add_lang_ident", "annotated_output", "run_all_rules", "rules_timeout",
+               "cascade_band", "disable_cascade"]
+    identity += repr([__version__] + [getattr(args, o) for o in options])
+    args.cache = ScoreCache(args.cache_size, args.cache_file, identity)
+
 def perform_scoring(args):
+    global _worker_args, _worker_pipeline
     time_start = default_timer()
     logging.info("Start scoring text")
 
     nline = 0
-    langid = None
-    
-    hardrules = Hardrules(args)
-    
-    for line in args.input:
-        nline += 1
-        parts = line.rstrip("\n").split("\t")
+    metrics = create_metrics(args)
+    checkpoint = create_checkpoint(args)
+    pipeline = create_pipeline(args, metrics)
+    # Reading, decompression, compression and writing run in background threads
+    if args.record_format is not None:
+        blocks = args.record_format.read_blocks(args.input, args.block_size, nline=checkpoint.input_lines)
+    else:
+        blocks = read_blocks_async(args.input, args.block_size, nline=checkpoint.input_lines)
+    blocks = checkpoint.track(blocks)
+    with AsyncWriter(args.output) as output:
+        # Score the first block in this process, so that workers
+        # inherit the hardrules order measured in the warm-up
+        for block_nline, lines in blocks if args.processes == 1 else islice(blocks, 1):
+            output.write(process_block(args, pipeline, lines, block_nline))
+            nline += len(lines)
+            metrics.checkpoint()
+            checkpoint.block_written()
+            checkpoint.checkpoint(output)
 
-        if len(parts) >= args.scol:
-            sentence = parts[args.scol-1]
-        else:
-            logging.error(f" scol ({args.scol}) index above column number ({len(parts)}) on line {nline}")
-            continue
-
-        # Obtain hardrules tag
-        tag = hardrules.wrong_segment(args, sentence)
-
-        # Language identification
-        # Only run if not disabled or not discarded or if it's requested in the output
-        if not args.disable_lang_ident and (args.add_lang_ident or tag == 'keep'):
-            # Obtain fastspell prediction, lowercasing helps in small langs
-            langid = args.fastspell.getlang(sentence.lower())
-
-            # Separate langid from the detected script
-            if args.detect_script:
-                langid_no_suffix = langid.split('_')[0]
-            else:
-                langid_no_suffix = langid
-
-            # Hardrule of langident here, to avoid calling fastspell two times
-            # have the language prediction available to print it
-            if not args.disable_hardrules \
-                    and langid_no_suffix != args.language:
-                if args.run_all_rules:
-                    if tag == 'keep':
-                        tag = 'no_wrong_language'
-                    else:
-                        tag += '+no_wrong_language'
-                else:
-                    if tag == 'keep':
-                        tag = 'no_wrong_language'
-
-        # Score with lm non discarded sentences
-        if tag == "keep":
-            score = args.ff.score(sentence)
-        else:
-            score = 0
-
-        # print sentence when no score_only
-        # always print score
-        # print identified language if requested
-        # print hardrule annotation if requested
-        if not args.score_only:
-            args.output.write(line.rstrip("\n") + '\t')
-        if tag != "keep":
-            args.output.write(f"{score}")
-        else:
-            args.output.write(f"{score:.3f}")
-        if args.add_lang_ident:
-            args.output.write('\t' + langid)
-        if args.annotated_output:
-            args.output.write('\t' + tag)
-        args.output.write("\n")
+        if args.processes > 1:
+            # Workers are forked after loading the model, so they all share it.
+            # They don't use the input and output, so forking with the I/O threads running is safe
+            _worker_args = args
+            _worker_pipeline = pipeline
+            workers = {}
+
+            with multiprocessing.get_context("fork").Pool(args.processes, initializer=_init_worker) as pool:
+                # Keep a bounded number of blocks in flight and write them in input order
+                for result in imap_bounded(pool, _process_block_worker, blocks, 2 * args.processes):
+                    block_output, pid, lines, elapsed, hits, misses, cascade_counts, block_metrics = result
+                    output.write(block_output)
+                    nline += lines
+                    metrics.merge(block_metrics)
+                    metrics.checkpoint()
+                    checkpoint.block_written()
+                    checkpoint.checkpoint(output)
+                    if args.cache is not None:
+                        args.cache.hits += hits
+                        args.cache.misses += misses
+                    args.cascade_counts[0] += cascade_counts[0]
+                    args.cascade_counts[1] += cascade_counts[1]
+                    stats = workers.setdefault(pid, [0, 0.0])
+                    stats[0] += lines
+                    stats[1] += elapsed
+
+        if args.record_format is not None and nline == 0:
+            # Empty inputs get an output with the fields too, Parquet files need their schema
+            output.write(args.record_format.format(args.record_format.empty_records(), output_fields(args, []), args.score_only))
+        checkpoint.write(output)
+
+    if args.output is not sys.stdout:
+        # Compressed files are only complete once closed
+        args.output.close()
+
+    pipeline.close()
+    metrics.close()
 
     # Print elapsed time and avg speed
     logging.info("Finished")
@@ -157,6 +392,16 @@ def perform_scoring(args):
     logging.info(f"Input lines: {nline} rows")
     logging.info(f"Elapsed time {elapsed_time:.2f} s")
     logging.info(f"Troughput: {int((nline * 1.0) / elapsed_time)} rows/s")
+    if args.processes > 1:
+        for pid, (lines, elapsed) in sorted(workers.items()):
+            logging.info(f"Troughput (worker {pid}): {int((lines * 1.0) / elapsed)} rows/s")
+    if args.cache is not None:
+        args.cache.close()
+        lookups = max(args.cache.hits + args.cache.misses, 1)
+        logging.info(f"Cache hits: {args.cache.hits}, misses: {args.cache.misses} ({100.0 * args.cache.hits / lookups:.1f}% hits)")
+    scored, escalated = args.cascade_counts
+    if scored:
+        logging.info(f"Cascade: {escalated} of {scored} sentences scored again with the full model ({100.0 * escalated / scored:.1f}%)")
 
     if args.output.name == '<stdout>':
         logging.info(f"Output file: {args.output.name}")
@@ -0,0 +1,59 @@
+import argparse
+import threading
+import logging
+import shutil
+import socket
+import sys
+
+try:
+    from .util import logging_setup
+except (SystemError, ImportError):
+    from util import logging_setup
+
+def initialization():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", type=str, required=True, help="Unix socket of a running monocleaner-server.")
+    parser.add_argument("input", type=argparse.FileType('rb'), nargs='?', help="Input file. If omitted, read from 'stdin'.")
+    parser.add_argument("output", type=argparse.FileType('wb'), nargs='?', help="Output tab-separated text file adding monocleaner score. When omitted output will be written to stdout.")
+    parser.add_argument("--debug", action='store_true')
+    parser.add_argument("-q", "--quiet", action='store_true')
+
+    args = parser.parse_args()
+
+    if args.output == None:
+        args.output = sys.stdout.buffer
+    if args.input == None:
+        args.input = sys.stdin.buffer
+
+    logging_setup(args)
+    logging.debug(args)
+    return args
+
+def send_input(sock, input):
+    ''' Send the whole input and tell the server that there is nothing else '''
+    with sock.makefile('wb') as sock_output:
+        shutil.copyfileobj(input, sock_output)
+    sock.shutdown(socket.SHUT_WR)
+
+def perform_request(args):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(args.socket)
+        except OSError as e:
+            logging.error(f"Can't connect to monocleaner-server at {args.socket}: {e}")
+            sys.exit(1)
+
+        # Send and receive at the same time, so neither side blocks on a full socket
+        sender = threading.Thread(target=send_input, args=(sock, args.input), daemon=True)
+        sender.start()
+        with sock.makefile('rb') as sock_input:
+            shutil.copyfileobj(sock_input, args.output)
+        sender.join()
+    args.output.flush()
+
+def main():
+    args = initialization()
+    perform_request(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+from timeit import default_timer
+import socketserver
+import logging
+import signal
+import stat
+import sys
+import io
+import os
+
+try:
+    from .monocleaner import argument_parser, setup, create_pipeline, process_block
+    from .util import logging_setup, read_blocks
+except (SystemError, ImportError):
+    from monocleaner import argument_parser, setup, create_pipeline, process_block
+    from util import logging_setup, read_blocks
+
+def initialization():
+    parser = argument_parser()
+    parser.add_argument("--socket", type=str, required=True, help="Unix socket path where scoring requests are accepted.")
+    # Each client is scored by a forked worker
+    parser.set_defaults(processes=os.cpu_count())
+
+    args = parser.parse_args()
+    logging_setup(args)
+    # Results cached by a forked worker would be lost when it exits
+    if args.cache_size or args.cache_file:
+        logging.error("--cache_size and --cache_file can't be used with the server, each client is scored in a forked process")
+        sys.exit(1)
+    setup(args)
+    return args
+
+class ScoringHandler(socketserver.StreamRequestHandler):
+    ''' Score the lines sent by a client and send back the output of each block '''
+
+    def handle(self):
+        args = self.server.args
+        time_start = default_timer()
+        nline = 0
+
+        # Decode like the monocleaner input file, with universal newlines
+        input = io.TextIOWrapper(self.rfile, encoding="utf-8")
+        for block_nline, lines in read_blocks(input, args.block_size):
+            output = process_block(args, self.server.pipeline, lines, block_nline)
+            self.wfile.write(output.encode("utf-8"))
+            nline += len(lines)
+
+        elapsed_time = default_timer() - time_start
+        logging.info(f"Client served: {nline} rows in {elapsed_time:.2f} s")
+
+class ScoringServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    '''
+    Unix socket server that keeps the model loaded and scores each client
+    in a forked process. When all workers are busy, new clients wait.
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        self.pipeline = create_pipeline(args)
+        self.max_children = args.processes
+        super().__init__(args.socket, ScoringHandler)
+
+def remove_socket(path):
+    ''' Remove the socket file left by a previous server '''
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.remove(path)
+
+def stop_serving(signum, frame):
+    raise KeyboardInterrupt()
+
+def perform_serving(args):
+    # Stop cleanly on SIGTERM as well as on Ctrl+C
+    signal.signal(signal.SIGTERM, stop_serving)
+    remove_socket(args.socket)
+    with ScoringServer(args) as server:
+        logging.info(f"Listening on {args.socket}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("Finished")
+        finally:
+            remove_socket(args.socket)
+            # Stop the tokenizer processes and save the hardrules warm-up stats
+            server.pipeline.close()
+
+def main():
+    args = initialization()
+    perform_serving(args)
+
+if __name__ == "__main__":
+    main()
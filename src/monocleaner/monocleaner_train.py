@@ -1,12 +1,15 @@
 from argparse import ArgumentParser
 import logging
+import numpy
+import yaml
+import sys
 
 try:
     from .lm import *
-    from .util import logging_setup, check_if_folder
+    from .util import logging_setup, check_if_folder, check_positive, check_positive_or_zero, check_positive_between_zero_and_one
 except (SystemError, ImportError):
     from lm import *
-    from util import logging_setup, check_if_folder
+    from util import logging_setup, check_if_folder, check_positive, check_positive_or_zero, check_positive_between_zero_and_one
 
 def initialization():
     parser = ArgumentParser()
@@ -17,28 +20,92 @@ def initialization():
     parser.add_argument("--dev", type=str, help="Development set to estimate mean and stddev perplexity")
     parser.add_argument("--lm_type", default=LMType.CHARACTER, type=lambda t: LMType[t], choices=list(LMType))
     parser.add_argument("--tokenizer_command", default=None, help="Tokenizer command to replace Moses tokenizer when using PLACEHOLDER LMType.")
+    parser.add_argument("--tokenizer_processes", default=0, type=check_positive_or_zero, help="Long-lived processes of the tokenizer command, fed with whole blocks. It must write each line as soon as it is read. 0 runs a new process for each block.")
+    parser.add_argument("-p", "--processes", default=1, type=check_positive, help="Number of processes tokenizing the training corpus.")
+    parser.add_argument("--pipe_arpa", action='store_true', help="Pipe the ARPA model into build_binary instead of writing it to a temporary file.")
+    parser.add_argument("--calibration_tolerance", default=0.0, type=check_positive_between_zero_and_one, help="Stop scoring the dev sets once the 95%% confidence intervals of perplexity mean and stddev are within this fraction of their values. Assumes a shuffled dev set. 0 scores them completely.")
+    parser.add_argument("--lm_structure", default="probing", choices=LM_STRUCTURES, help="Data structure of the binary KenLM model. trie is smaller and slower, probing is faster")
+    parser.add_argument("--quantize_bits", default=0, type=check_positive_or_zero, help=f"Bits used to store each probability and backoff of a trie model, up to {MAX_QUANTIZE_BITS}. 0 disables quantization")
+    parser.add_argument("--load_method", choices=list(LOAD_METHODS), help="How the model will be loaded when scoring, recorded in the metadata. When omitted, monocleaner picks it")
+    parser.add_argument("--cascade_order", default=0, type=check_positive_or_zero, help=f"Also train a model of this order, from {MIN_CASCADE_ORDER} to {LM_ORDER - 1}, that scores sentences first. Only those it can't decide are scored with the full model. 0 disables it")
+    parser.add_argument("--cascade_band", default=0.25, type=check_positive_between_zero_and_one, help="Sentences whose score with the cascade model is less than this away from 0.5 are scored with the full model, up to 0.5. Recorded in the metadata")
     parser.add_argument("--debug", action='store_true')
     parser.add_argument("-q", "--quiet", action='store_true')
 
     args = parser.parse_args()
     args.lm_file_name = 'lm.' + args.language
     args.lm_file_path = args.model_dir + '/' + args.lm_file_name
+    args.cascade_lm_file_name = f"{args.lm_file_name}.{args.cascade_order}gram"
+    args.cascade_lm_file_path = args.model_dir + '/' + args.cascade_lm_file_name
 
     logging_setup(args)
+    if args.quantize_bits > MAX_QUANTIZE_BITS:
+        logging.error(f"--quantize_bits can't be above {MAX_QUANTIZE_BITS}")
+        sys.exit(1)
+    if args.quantize_bits and args.lm_structure != "trie":
+        logging.error("--quantize_bits is only supported by --lm_structure trie")
+        sys.exit(1)
+    if args.cascade_order and not MIN_CASCADE_ORDER <= args.cascade_order < LM_ORDER:
+        logging.error(f"--cascade_order must be from {MIN_CASCADE_ORDER} to {LM_ORDER - 1}")
+        sys.exit(1)
+    if args.cascade_band > 0.5:
+        logging.error("--cascade_band can't be above 0.5")
+        sys.exit(1)
     logging.debug(args)
 
     return args
 
-def write_metadata(stats: LMStats, args):
+def write_metadata(stats: LMStats, args, cascade_stats: LMStats = None):
     ''' Write lm file and perplexity stats to metadata file '''
     with open(args.model_dir + '/metadata.yaml', 'w+') as out:
         out.write(f"language: {args.language}\n")
         out.write(f"lm_file: {args.lm_file_name}\n")
-        out.write(f"lm_type: CHARACTER\n")
+        out.write(f"lm_type: {args.lm_type.name}\n")
+        if args.tokenizer_command:
+            # The command is quoted, it may have characters special to YAML
+            yaml.safe_dump({"tokenizer_command": args.tokenizer_command}, out, width=float("inf"))
         out.write(f"clean_mean_perp: {stats.clean_mean}\n")
         out.write(f"clean_stddev_perp: {stats.clean_stddev}\n")
         out.write(f"noisy_mean_perp: {stats.noisy_mean}\n")
         out.write(f"noisy_stddev_perp: {stats.noisy_stddev}\n")
+        for name, (low, high) in stats.intervals.items():
+            out.write(f"{name}_perp_ci: [{low}, {high}]\n")
+        out.write(f"lm_structure: {args.lm_structure}\n")
+        out.write(f"quantize_bits: {args.quantize_bits}\n")
+        if args.load_method:
+            out.write(f"load_method: {args.load_method}\n")
+        if cascade_stats is not None:
+            out.write(f"cascade_lm_file: {args.cascade_lm_file_name}\n")
+            out.write(f"cascade_order: {args.cascade_order}\n")
+            out.write(f"cascade_band: {args.cascade_band}\n")
+            out.write(f"cascade_clean_mean_perp: {cascade_stats.clean_mean}\n")
+            out.write(f"cascade_clean_stddev_perp: {cascade_stats.clean_stddev}\n")
+            out.write(f"cascade_noisy_mean_perp: {cascade_stats.noisy_mean}\n")
+            out.write(f"cascade_noisy_stddev_perp: {cascade_stats.noisy_stddev}\n")
+
+def report_cascade(args, stats: LMStats, cascade_stats: LMStats, dev_files):
+    ''' Log how many dev sentences the cascade sends to the full model and how close its scores are to the full model ones '''
+    ff = LMFluencyFilter(args.lm_type, args.language, args.tokenizer_command, args.tokenizer_processes)
+    ff.load(args.lm_file_path, stats)
+    ff.load_cascade(args.cascade_lm_file_path, cascade_stats, args.cascade_band)
+    sentences = []
+    for dev_file in dev_files:
+        with open(dev_file) as dev_f:
+            sentences.extend(line.rstrip("\n") for line in dev_f)
+
+    cascade, processed_sents, counts = ff.cascade_scores(sentences)
+    full = ff.scoring_stats.perplexity_to_score_batch(
+            ff._kenlm_scores(processed_sents, counts) / (numpy.array(counts, dtype=numpy.float64) + 1))
+    ff.tokenizer.close()
+
+    logging.info(f"Cascade of the {args.cascade_order}-gram model on {len(sentences)} clean and noisy dev sentences")
+    for band in sorted({0.1, 0.2, 0.3, 0.4, 0.5, args.cascade_band}):
+        escalated = numpy.abs(cascade - 0.5) < band
+        scores = numpy.where(escalated, full, cascade)
+        difference = numpy.abs(scores - full)
+        agreement = ((scores >= 0.5) == (full >= 0.5)).mean()
+        logging.info(f"Band {band}{' (chosen)' if band == args.cascade_band else ''}: {escalated.mean():.1%} scored by the full model, "
+                     f"score difference mean {difference.mean():.4f} max {difference.max():.4f}, {agreement:.1%} on the same side of 0.5")
 
 def perform_training(args):
     logging.info("Shuffling input text")
@@ -55,22 +122,27 @@ def perform_training(args):
 
     try:
         # Train language model
-        ff = LMFluencyFilter(args.lm_type, args.language, args.tokenizer_command)
+        ff = LMFluencyFilter(args.lm_type, args.language, args.tokenizer_command, args.tokenizer_processes)
         logging.info("Training LM")
-        ff.train(train_file, dev_file, dev_noisy, args.lm_file_path)
+        stats = ff.train(train_file, dev_file, dev_noisy, args.lm_file_path, args.processes, args.pipe_arpa,
+                         args.calibration_tolerance, args.lm_structure, args.quantize_bits)
 
-        # Compute mean and stddev stats of noisy and clean text
-        clean_mean, clean_stdev = ff.estimate_threshold(dev_file)
-        noisy_mean, noisy_stdev = ff.estimate_threshold(dev_noisy)
-        stats = LMStats(clean_mean, clean_stdev, noisy_mean, noisy_stdev)
         logging.info("Perplexity stats")
-        logging.info(f"Clean mean: {clean_mean}")
-        logging.info(f"Clean std dev: {clean_stdev}")
-        logging.info(f"Noisy mean: {noisy_mean}")
-        logging.info(f"Noisy std dev: {noisy_mean}")
+        for name in ("clean_mean", "clean_stddev", "noisy_mean", "noisy_stddev"):
+            low, high = stats.intervals[name]
+            logging.info(f"{name.replace('_', ' ').capitalize()}: {getattr(stats, name)} (95% CI {low} - {high})")
+
+        cascade_stats = None
+        if args.cascade_order:
+            logging.info(f"Training {args.cascade_order}-gram cascade LM")
+            cascade_ff = LMFluencyFilter(args.lm_type, args.language, args.tokenizer_command, args.tokenizer_processes)
+            cascade_stats = cascade_ff.train(train_file, dev_file, dev_noisy, args.cascade_lm_file_path, args.processes,
+                                             args.pipe_arpa, args.calibration_tolerance, args.lm_structure,
+                                             args.quantize_bits, args.cascade_order)
+            report_cascade(args, stats, cascade_stats, (dev_file, dev_noisy))
 
         # Write stats and lm_file path to metadata
-        write_metadata(stats, args)
+        write_metadata(stats, args, cascade_stats)
         logging.info(f"Model and metadata saved at: {args.model_dir}")
     finally:
         os.remove(train_file)
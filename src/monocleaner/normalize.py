@@ -9,6 +9,8 @@ import re
 import regex
 
 from itertools import chain
+from functools import partial
+from operator import methodcaller
 
 
 class MosesPunctNormalizer:
@@ -133,6 +135,27 @@ class MosesPunctNormalizer:
 
     CONTROL_CHARS = regex.compile(r"\p{C}")
 
+    # Single pass equivalents of the NORMALIZE_UNICODE and FRENCH_QUOTES chains.
+    # All the literal NORMALIZE_UNICODE replacements are applied with one translate,
+    # the contextual ‘ and ’ rules give the same result as the literal ones
+    # and "´´" can't match after "´" has been replaced.
+    NORMALIZE_UNICODE_TABLE = str.maketrans({
+        "„": '"', "“": '"', "”": '"', "–": "-", "—": " - ", "´": "'",
+        "‘": "'", "‚": "'", "’": "'", "…": "...",
+    })
+    FRENCH_OPEN_QUOTES = re.compile("\u00A0«\u00A0|«\u00A0?")
+    FRENCH_CLOSE_QUOTES = re.compile("\u00A0»\u00A0?|»")
+
+    # Substring that has to be in the text for a pattern to change it,
+    # used to skip the passes that can't apply
+    GUARDS = {
+        r"\r": "\r", r"\(": "(", r"\)": ")", r" +": "  ",
+        r"\) ([.!:?;,])": ") ", r"\( ": "( ", r" \)": " )",
+        r"(\d) %": " %", r" :": " :", r" ;": " ;",
+        r"`": "`", r"''": "''",
+        r'"([,.]+)': '"', r',"': ',"', r'(\.+)"(\s*[^<])': '."',
+    }
+
     def __init__(
         self,
         lang="en",
@@ -152,7 +175,7 @@ class MosesPunctNormalizer:
         :param norm_numbers: Normalize numbers
         :type norm_numbers: bool
         """
-        self.substitutions = [
+        tables = [
             self.EXTRA_WHITESPACE,
             self.NORMALIZE_UNICODE,
             self.FRENCH_QUOTES,
@@ -160,25 +183,54 @@ class MosesPunctNormalizer:
         ]
 
         if penn:  # Adds the penn substitutions after extra_whitespace regexes.
-            self.substitutions.insert(1, self.NORMALIZE_UNICODE_IF_NOT_PENN)
+            tables.insert(1, self.NORMALIZE_UNICODE_IF_NOT_PENN)
 
         if norm_quote_commas:
             if lang == "en":
-                self.substitutions.append(self.EN_QUOTATION_FOLLOWED_BY_COMMA)
+                tables.append(self.EN_QUOTATION_FOLLOWED_BY_COMMA)
             elif lang in ["de", "es", "fr"]:
-                self.substitutions.append(self.DE_ES_FR_QUOTATION_FOLLOWED_BY_COMMA)
+                tables.append(self.DE_ES_FR_QUOTATION_FOLLOWED_BY_COMMA)
 
         if norm_numbers:
             if lang in ["de", "es", "cz", "cs", "fr"]:
-                self.substitutions.append(self.DE_ES_CZ_CS_FR)
+                tables.append(self.DE_ES_CZ_CS_FR)
             else:
-                self.substitutions.append(self.OTHER)
+                tables.append(self.OTHER)
 
-        self.substitutions = list(chain(*self.substitutions))
+        # Reference chain of substitutions, normalize() runs the equivalent passes
+        self.substitutions = list(chain(*tables))
+        self.passes = list(chain(*map(self._compile, tables)))
 
         self.pre_replace_unicode_punct = pre_replace_unicode_punct
         self.post_remove_control_chars = post_remove_control_chars
 
+    def _compile(self, table):
+        """
+        Returns the (guard, function) passes equivalent to a table of substitutions.
+        """
+        if table is self.NORMALIZE_UNICODE:
+            return [
+                (None, methodcaller("translate", self.NORMALIZE_UNICODE_TABLE)),
+                ("  ", partial(re.compile(r" +").sub, " ")),
+                ("''", partial(re.compile(r"''").sub, '"')),
+            ]
+        if table is self.FRENCH_QUOTES:
+            return [
+                ("«", partial(self.FRENCH_OPEN_QUOTES.sub, '"')),
+                ("»", partial(self.FRENCH_CLOSE_QUOTES.sub, '"')),
+            ]
+
+        passes = []
+        for regexp, substitution in table:
+            if regexp.pattern in self.GUARDS:
+                guard = self.GUARDS[regexp.pattern]
+            elif "\u00A0" in regexp.pattern:
+                guard = "\u00A0"
+            else:
+                guard = None
+            passes.append((guard, partial(regexp.sub, substitution)))
+        return passes
+
     def normalize(self, text):
         """
         Returns a string with normalized punctuation.
@@ -187,11 +239,10 @@ class MosesPunctNormalizer:
         if self.pre_replace_unicode_punct:
             text = self.replace_unicode_punct(text)
 
-        # Actual normalization.
-        for regexp, substitution in self.substitutions:
-            # print(regexp, substitution)
-            text = regexp.sub(substitution, str(text))
-            # print(text)
+        # Actual normalization, skipping the passes that can't change the text.
+        for guard, substitute in self.passes:
+            if guard is None or guard in text:
+                text = substitute(text)
 
         # Optionally, replace unicode puncts BEFORE normalization.
         if self.post_remove_control_chars:
@@ -199,10 +250,27 @@ class MosesPunctNormalizer:
 
         return text.strip()
 
+    def normalize_reference(self, text):
+        """
+        Returns a string with normalized punctuation applying the whole chain
+        of substitutions one by one. Slow, used to verify normalize().
+        """
+        if self.pre_replace_unicode_punct:
+            text = self.replace_unicode_punct(text)
+
+        for regexp, substitution in self.substitutions:
+            text = regexp.sub(substitution, text)
+
+        if self.post_remove_control_chars:
+            text = self.remove_control_chars(text)
+
+        return text.strip()
+
     def replace_unicode_punct(self, text):
         for regexp, substitution in self.REPLACE_UNICODE_PUNCTUATION:
             text = regexp.sub(substitution, str(text))
         return text
 
     def remove_control_chars(self, text):
-        return CONTROL_CHARS.sub("", text)
+        return self.CONTROL_CHARS.sub("", text)
+
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+import logging
+import yaml
+import os
+
+
+def find_model_packs(models_dir):
+    '''
+    Directory and KenLM files size of each language in a directory of model packs,
+    one subdirectory per language as laid out by monocleaner-download
+    '''
+    packs = {}
+    for name in sorted(os.listdir(models_dir)):
+        model_dir = os.path.join(models_dir, name)
+        metadata_path = os.path.join(model_dir, "metadata.yaml")
+        if not os.path.isfile(metadata_path):
+            continue
+        with open(metadata_path) as file_:
+            metadata = yaml.safe_load(file_)
+        language = metadata["language"]
+        if language in packs:
+            logging.warning(f"Ignoring {model_dir}, there is another model pack for '{language}' in {packs[language][0]}")
+            continue
+        lm_files = [metadata["lm_file"]] + ([metadata["cascade_lm_file"]] if "cascade_lm_file" in metadata else [])
+        packs[language] = (model_dir, sum(os.path.getsize(os.path.join(model_dir, f)) for f in lm_files))
+    return packs
+
+
+class ModelRegistry():
+    '''
+    Scoring pipelines of several languages, each one loaded the first time its
+    language is seen. When the KenLM files of the loaded models are above the
+    memory budget, the least recently used ones are unloaded.
+    '''
+
+    def __init__(self, packs, load, memory=0):
+        """
+            packs: model pack directory and KenLM file size of each language
+            load: function returning the pipeline of a language given the language and its model pack directory
+            memory: budget in bytes, 0 keeps all the loaded models
+        """
+        self.packs = packs
+        self.load = load
+        self.memory = memory
+        self.used = 0
+        self.loaded = OrderedDict() # language -> pipeline, least recently used first
+        self.missing = set()
+
+    def get(self, language):
+        ''' Pipeline of a language, None if there is no model pack for it '''
+        pipeline = self.loaded.get(language)
+        if pipeline is not None:
+            self.loaded.move_to_end(language)
+            return pipeline
+
+        if language not in self.packs:
+            if language not in self.missing:
+                logging.warning(f"No model pack for language '{language}', its sentences get score 0")
+                self.missing.add(language)
+            return None
+
+        model_dir, size = self.packs[language]
+        # The model being loaded is always kept, even if it is above the budget on its own
+        while self.memory and self.loaded and self.used + size > self.memory:
+            self.unload(next(iter(self.loaded)))
+        logging.info(f"Loading model pack of '{language}' from {model_dir}")
+        pipeline = self.load(language, model_dir)
+        self.loaded[language] = pipeline
+        self.used += size
+        return pipeline
+
+    def unload(self, language):
+        logging.info(f"Unloading model pack of '{language}'")
+        self.loaded.pop(language).close()
+        self.used -= self.packs[language][1]
+
+    def close(self):
+        for language in list(self.loaded):
+            self.unload(language)
+
+
+class MultilingualPipeline():
+    '''
+    Score blocks of sentences of several languages, each sentence with the
+    pipeline of its language. The sentences of each language are scored together.
+    '''
+
+    def __init__(self, registry, metrics):
+        self.registry = registry
+        self.metrics = metrics
+
+    def process(self, sentences, languages):
+        ''' Return score, language and hardrules tag of each sentence '''
+        groups = {}
+        for i, language in enumerate(languages):
+            groups.setdefault(language, []).append(i)
+
+        results = [None] * len(sentences)
+        for language, indexes in groups.items():
+            pipeline = self.registry.get(language)
+            if pipeline is None:
+                for i in indexes:
+                    results[i] = (0, language, 'no_wrong_language')
+                continue
+            for i, result in zip(indexes, pipeline.process([sentences[i] for i in indexes])):
+                results[i] = result
+        return results
+
+    def close(self):
+        self.registry.close()
@@ -0,0 +1,189 @@
+from timeit import default_timer
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
+import regex
+
+# Detection of the repetitions discarded by the no_repeated_words hardrule, with
+# the same decisions as finditer with its regexes but without their backtracking:
+#   repeated words      (?i)(\b\S+(.+))\s+\b\1\b
+#   repeated substrings (.+)\1
+# Candidate repetitions are only looked for where the first word or the first two
+# characters occur again, and each candidate is checked with one comparison.
+
+# Candidates checked per character of the sentence before giving up with TimeoutError.
+# Natural text checks less than 4, the cap bounds the cost of pathological lines
+MAX_CANDIDATES_PER_CHAR = 32
+# Candidates checked between checks of the deadline
+DEADLINE_CHECK_INTERVAL = 256
+
+regex_repeated_words = regex.compile(r"(?i)(\b\S+(.+))\s+\b\1\b")
+regex_repeated_without_words = regex.compile(r"(.+)\1")
+regex_alpha = regex.compile("[[:alpha:]]")
+regex_tokens = regex.compile(r"\S+")
+regex_word_starts = regex.compile(r"\b\w")
+regex_word = regex.compile(r"\w")
+# Case insensitive matching of these is not transitive (İ~i~I~ı), sentences with them use the regex
+NON_TRANSITIVE_CASE = ("İ", "ı")
+
+# Highest code point with case variants
+MAX_CASED = 0x1E943
+
+@lru_cache(maxsize=None)
+def case_fold_table():
+    '''
+    Translation table to the representative of each set of characters that
+    match each other in (?i) backreferences, built on first use
+    '''
+    parent = {}
+    def find(c):
+        while parent.get(c, c) != c:
+            c = parent[c]
+        return c
+
+    for i in range(MAX_CASED + 1):
+        c = chr(i)
+        if c in NON_TRANSITIVE_CASE:
+            continue
+        for variant in (c.lower(), c.upper(), c.casefold(), c.title()):
+            if len(variant) == 1 and variant != c and variant not in NON_TRANSITIVE_CASE \
+                    and regex.fullmatch(r"(?i)(.)\1", c + variant):
+                a, b = find(c), find(variant)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+    return str.maketrans({c: find(c) for c in parent if find(c) != c})
+
+def _qualifies(match, min_chars):
+    ''' Whether a repetition found is long enough and has letters '''
+    match = match.strip()
+    return len(match) > min_chars and regex_alpha.search(match) is not None
+
+class _Budget():
+    ''' Candidates and time allowed to a sentence, TimeoutError is raised when exceeded '''
+
+    def __init__(self, length, deadline):
+        self.candidates_left = MAX_CANDIDATES_PER_CHAR * (length + 1)
+        self.deadline = deadline
+
+    def spend(self):
+        self.candidates_left -= 1
+        if self.candidates_left < 0:
+            raise TimeoutError("too many candidate repetitions")
+        if self.deadline is not None and self.candidates_left % DEADLINE_CHECK_INTERVAL == 0 \
+                and default_timer() > self.deadline:
+            raise TimeoutError("repetition detection time exceeded")
+
+def repeated_words(sentence: str, min_chars: int, deadline: float = None, timeout: float = None):
+    '''
+    Whether finditer of (?i)(\\b\\S+(.+))\\s+\\b\\1\\b finds a match longer than
+    min_chars once stripped and with letters. deadline is a default_timer() value,
+    timeout the time allowed to the regex fallback.
+    '''
+    if any(c in sentence for c in NON_TRANSITIVE_CASE):
+        return any(_qualifies(m.group(), min_chars)
+                   for m in regex_repeated_words.finditer(sentence, timeout=timeout))
+
+    n = len(sentence)
+    folded = sentence.translate(case_fold_table())
+    budget = _Budget(n, deadline)
+    # Tokens are the candidate starts of the second copy, which follows whitespace
+    token_starts, token_ends = [], []
+    tokens = {} # folded token -> starts
+    for m in regex_tokens.finditer(sentence):
+        token_starts.append(m.start())
+        token_ends.append(m.end())
+        tokens.setdefault(folded[m.start():m.end()], []).append(m.start())
+    newline = sentence.find("\n")
+
+    pos = 0
+    for start in regex_word_starts.finditer(sentence):
+        p = start.start()
+        if p < pos:
+            continue
+        # End of the token of p, the first copy ends at whitespace after it
+        t = bisect_right(token_starts, p) - 1
+        token_end = token_ends[t]
+        if t + 1 == len(token_starts):
+            break
+        # The first copy can't span lines
+        last_end = sentence.find("\n", p) if newline != -1 else -1
+        if last_end == -1:
+            last_end = n
+
+        # Starts of the second copy from the last one, so the longest match is found first:
+        # tokens equal to the rest of the token of p, and the token following it
+        same = tokens.get(folded[p:token_end], [])
+        candidates = same[bisect_right(same, token_end):]
+        next_start = token_starts[t + 1]
+        if not candidates or candidates[0] != next_start:
+            candidates.insert(0, next_start)
+
+        found = None
+        for i in range(len(candidates) - 1, -1, -1):
+            q = candidates[i]
+            # The first copy ends in the whitespace before q, after at least 2 characters
+            gap_start = token_ends[bisect_right(token_starts, q) - 2]
+            for e in range(min(q - 1, n - q + p, last_end), max(gap_start, p + 2) - 1, -1):
+                length = e - p
+                budget.spend()
+                end = q + length
+                # The second copy ends at a word boundary
+                if folded[p:e] == folded[q:end] \
+                        and (regex_word.match(sentence, end - 1, end) is None) \
+                            != (regex_word.match(sentence, end, end + 1) is None):
+                    found = end
+                    break
+            if found is not None:
+                break
+
+        if found is not None:
+            if _qualifies(sentence[p:found], min_chars):
+                return True
+            pos = found
+    return False
+
+def repeated_substrings(sentence: str, min_chars: int, deadline: float = None):
+    '''
+    Whether finditer of (.+)\\1 finds a match longer than min_chars once stripped
+    and with letters. deadline is a default_timer() value.
+    '''
+    n = len(sentence)
+    budget = _Budget(n, deadline)
+    # Positions of each pair of characters, the start of any repetition longer than 1
+    pairs = {}
+    for i in range(n - 1):
+        pairs.setdefault(sentence[i:i+2], []).append(i)
+
+    # Starts of possible repetitions: doubled characters and repeated pairs
+    starts = sorted({i for i in range(n - 1) if sentence[i] == sentence[i+1]}
+                    | {i for positions in pairs.values() if len(positions) > 1 for i in positions[:-1]})
+
+    pos = 0
+    i = 0
+    while i < len(starts):
+        p = starts[i]
+        i += 1
+        if p < pos or sentence[p] == "\n":
+            continue
+        line_end = sentence.find("\n", p)
+        max_length = min((n - p) // 2, (line_end if line_end != -1 else n) - p)
+
+        # Longest repetition first: later occurrences of the pair at p, then the doubled character
+        found = 0
+        same = pairs[sentence[p:p+2]]
+        for k in range(bisect_right(same, p + max_length) - 1, bisect_left(same, p + 2) - 1, -1):
+            length = same[k] - p
+            budget.spend()
+            # The last characters first, most candidates differ there
+            if sentence[p+length-1] == sentence[p+2*length-1] \
+                    and sentence[p:p+length] == sentence[p+length:p+2*length]:
+                found = length
+                break
+        if not found and max_length >= 1 and sentence[p] == sentence[p+1]:
+            found = 1
+
+        if found:
+            if _qualifies(sentence[p:p+2*found], min_chars):
+                return True
+            pos = p + 2 * found
+            i = bisect_left(starts, pos, i)
+    return False
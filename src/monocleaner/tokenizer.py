@@ -1,9 +1,11 @@
 from sacremoses import MosesTokenizer
-from toolwrapper import ToolWrapper
+from toolwrapper import ToolWrapper, ToolException
+from threading import Thread
 from subprocess import run, PIPE
 import logging
 import sys
 import os
+import re
 
 try:
     from .util import no_escaping
@@ -12,22 +14,34 @@ except (SystemError, ImportError):
 
 
 class Tokenizer:
-    def __init__(self, command=None,  l="en"):
+    def __init__(self, command=None,  l="en", processes=0):
+        '''
+        processes: number of long-lived processes of the external tokenizer that
+                   tokenize lists, instead of running a new process for each list.
+                   The tokenizer must write each output line as soon as it reads the input line.
+        '''
         if command:
             self.cmd = command.split(' ')
             self.tokenizer = ToolWrapper(self.cmd)
             self.external =  True
             self.spm = command.find('spm_encode') > -1
+            self.pool = [self.tokenizer] + [ToolWrapper(self.cmd) for _ in range(processes - 1)] if processes else []
+            self.pid = os.getpid()
         else:
             self.tokenizer = MosesTokenizer(lang=l)
             self.external = False
             self.spm = False
             self.cmd = None
+            self.pool = []
 
     def tokenize(self, text):
         if self.external:
-            if isinstance(text, list):
-                return self.tokenize_block('\n'.join(text) + '\n').split('\n')
+            self._check_fork()
+            if isinstance(text, list) and self.pool:
+                return self.tokenize_pool(text)
+            elif isinstance(text, list):
+                output = self.tokenize_block('\n'.join(text) + '\n').split('\n')
+                return [[no_escaping(t) for t in line.split()] for line in output[:len(text)]]
             else:
                 self.tokenizer.writeline(text.rstrip('\n'))
                 return ([no_escaping(t) for t in self.tokenizer.readline().rstrip('\n').split()])
@@ -43,20 +57,98 @@ class Tokenizer:
         else:
             return ' '.join(text)
 
+    def _processes(self):
+        return self.pool if self.pool else [self.tokenizer]
+
     def close(self):
-        if self.external:
+        # Processes inherited from the parent are not closed, they belong to it
+        if self.external and self.pid == os.getpid():
             try:
-                self.tokenizer.close()
+                for process in self._processes():
+                    process.close()
             except:
                 return
 
     def start(self):
         if self.external:
-            self.tokenizer.start()
+            for process in self._processes():
+                process.start()
 
     def restart(self):
         if self.external:
-            self.tokenizer.restart()
+            for process in self._processes():
+                process.restart()
+
+    def _check_fork(self):
+        '''
+        Start new tokenizer processes in a forked child. The inherited ones belong
+        to the parent, they are detached without killing them.
+        '''
+        if self.pid == os.getpid():
+            return
+        for process in self._processes():
+            process.stdin.close()
+            process.stdout.close()
+            process.closed = True
+            process.start()
+        self.pid = os.getpid()
+
+    def tokenize_pool(self, text):
+        ''' Tokenize a list of lines splitting it in contiguous chunks, one for each process of the pool '''
+        if not text:
+            return []
+        size = -(-len(text) // len(self.pool))
+        chunks = [text[i:i+size] for i in range(0, len(text), size)]
+        outputs = [None] * len(chunks)
+        errors = []
+
+        def run(i):
+            try:
+                outputs[i] = self._tokenize_process(self.pool[i], chunks[i])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=run, args=(i,)) for i in range(len(chunks))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            logging.error(f"Tokenizer {self.cmd!r} failed: {errors[0]}")
+            sys.exit(1)
+        return [tokens for output in outputs for tokens in output]
+
+    def _tokenize_process(self, process, lines, retry=True):
+        '''
+        Tokenize lines with a process of the pool. Lines are written by another thread
+        while the output is read, so the pipes never fill up and block both sides.
+        A crashed process is restarted and the lines sent again once.
+        '''
+        def feed():
+            try:
+                process.stdin.write(''.join(line + '\n' for line in lines))
+                process.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                # The process died, the missing output is detected below
+                pass
+
+        feeder = Thread(target=feed)
+        feeder.start()
+        output = []
+        for _ in lines:
+            line = process.stdout.readline()
+            if not line.endswith('\n'):
+                break
+            output.append(line)
+        feeder.join()
+
+        if len(output) < len(lines):
+            if not retry:
+                raise ToolException(f"process exited after {len(output)} of {len(lines)} lines")
+            logging.warning(f"Tokenizer process {process.proc.pid} exited, restarting it")
+            process.restart()
+            return self._tokenize_process(process, lines, retry=False)
+        return [[no_escaping(t) for t in line.split()] for line in output]
 
     def tokenize_block(self, text):
         logging.debug(f'Opening subprocess: {self.cmd!r}')
@@ -68,3 +160,46 @@ class Tokenizer:
             logging.debug(f'Succesfully subprocess: {self.cmd!r}')
             logging.debug(f'Errors: {output.stderr}')
             return output.stdout
+
+
+class CharTokenizer:
+    '''
+    Tokenizer of CHARACTER models: one token per character with SPACE for spaces,
+    or one token per UTF-8 byte for byte-level models. Returns the number of tokens
+    along with each tokenized text, so that it doesn't need to be split again.
+    '''
+    BYTE_TOKENS = tuple(str(b) for b in range(256))
+    # Whitespace other than space, dropped when the tokenized text is split
+    OTHER_SPACE = re.compile(r"[^\S ]")
+
+    def __init__(self, byte_level=False):
+        self.byte_level = byte_level
+
+    def tokenize(self, text):
+        return self.tokenize_count(text)[0]
+
+    def tokenize_count(self, text):
+        if self.byte_level:
+            encoded = text.encode()
+            return " ".join(map(self.BYTE_TOKENS.__getitem__, encoded)), len(encoded)
+
+        if "  " in text or text.startswith(" ") or text.endswith(" "):
+            tokline = " ".join(["SPACE" if c == " " else c for c in text])
+        else:
+            # Every space is between other characters, so it becomes exactly three spaces when joined
+            tokline = " ".join(text).replace("   ", " SPACE ")
+
+        # Whitespace other than space is never printable, a faster check than the regex
+        if text.isprintable() or self.OTHER_SPACE.search(text) is None:
+            return tokline, len(text)
+        return tokline, len(text) - len(self.OTHER_SPACE.findall(text))
+
+    def tokenize_batch(self, texts):
+        ''' Tokenized texts and their number of tokens '''
+        toklines = []
+        counts = []
+        for text in texts:
+            tokline, count = self.tokenize_count(text)
+            toklines.append(tokline)
+            counts.append(count)
+        return toklines, counts
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import os
+import io
 import argparse
 import logging
 import re
@@ -11,6 +12,13 @@ import typing
 import random
 
 from tempfile import TemporaryFile
+import threading
+import queue
+import gzip
+import lzma
+from collections import deque
+from array import array
+from itertools import islice
 from toolwrapper import ToolWrapper
 
 # variables used by the no_escaping function
@@ -48,6 +56,13 @@ def check_positive_or_zero(value):
         raise argparse.ArgumentTypeError("%s is an invalid positive int value" % value)
     return ivalue
 
+# Check if the argument of a program (argparse) is a positive or zero float
+def check_positive_or_zero_float(value):
+    fvalue = float(value)
+    if fvalue < 0:
+        raise argparse.ArgumentTypeError("%s is an invalid positive float value" % value)
+    return fvalue
+
 # Check if the argument of a program (argparse) is strictly positive
 def check_positive(value):
     ivalue = int(value)
@@ -86,18 +101,198 @@ def logging_setup(args = None):
     if logging_level <= logging.WARNING and logging_level != logging.DEBUG:
         logging.getLogger("ToolWrapper").setLevel(logging.WARNING)
 
-def shuffle_file(input: typing.TextIO, output: typing.TextIO):
-    offsets=[]
-    with TemporaryFile("w+") as temp:
-        count = 0
+# Yield blocks of input lines with the number of lines before each block
+def read_blocks(input: typing.TextIO, block_size: int):
+    nline = 0
+    while True:
+        lines = list(islice(input, block_size))
+        if not lines:
+            return
+        yield nline, lines
+        nline += len(lines)
+
+# Characters read at once by read_blocks_async
+READ_CHUNK_SIZE = 1024**2
+
+def open_file(path: str, mode: str = "r"):
+    ''' Open a text file, compressed or decompressed according to its extension (.gz, .xz or .zst) '''
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t")
+    if path.endswith(".xz"):
+        return _NamedTextIOWrapper(lzma.open(path, mode + "b"), path)
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            logging.error("zstandard is needed for .zst files, install it with 'pip install zstandard'")
+            sys.exit(1)
+        return _NamedTextIOWrapper(zstandard.open(path, mode + "b"), path)
+    return open(path, mode)
+
+class _NamedTextIOWrapper(io.TextIOWrapper):
+    ''' TextIOWrapper with the name of the file, lzma and zstandard streams don't have it '''
+    name = None
+
+    def __init__(self, buffer, name):
+        super().__init__(buffer)
+        self.name = name
+
+# argparse.FileType that opens compressed files with open_file
+class CompressedFileType(argparse.FileType):
+    def __call__(self, string):
+        if string == '-':
+            return super().__call__(string)
+        try:
+            return open_file(string, self._mode)
+        except OSError as e:
+            raise argparse.ArgumentTypeError(f"can't open '{string}': {e}")
+
+# Same as read_blocks but reading large chunks of text and splitting them at once
+def _read_chunked_blocks(input: typing.TextIO, block_size: int, nline: int = 0):
+    lines = []
+    pending = ""
+    while True:
+        chunk = input.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        parts = (pending + chunk).split("\n")
+        pending = parts.pop()
+        lines.extend([part + "\n" for part in parts])
+        while len(lines) >= block_size:
+            yield nline, lines[:block_size]
+            del lines[:block_size]
+            nline += block_size
+    if pending:
+        lines.append(pending)
+    if lines:
+        yield nline, lines
+
+# Yield blocks like read_blocks, read and decompressed by a background thread
+# that keeps at most prefetch blocks ahead. Line numbers start at nline
+def read_blocks_async(input: typing.TextIO, block_size: int, prefetch: int = 4, nline: int = 0):
+    return iterate_async(_read_chunked_blocks(input, block_size, nline), prefetch)
+
+# Yield the items of iterable, produced by a background thread that keeps
+# at most prefetch items ahead. Its errors are raised when they are reached
+def iterate_async(iterable, prefetch: int = 4):
+    items = queue.Queue(prefetch)
+
+    def producer():
+        try:
+            for item in iterable:
+                items.put(item)
+            items.put(None)
+        except BaseException as e:
+            items.put(e)
+
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is None:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+class AsyncWriter:
+    '''
+    Write to output from a background thread, so that compression and
+    writing overlap with scoring. Errors are raised on the next write or close.
+    '''
+    def __init__(self, output: typing.TextIO, max_pending: int = 4):
+        self.output = output
+        self.pending = queue.Queue(max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def _writer(self):
+        while True:
+            data = self.pending.get()
+            if data is None:
+                self.pending.task_done()
+                return
+            if self.error is None:
+                try:
+                    self.output.write(data)
+                except BaseException as e:
+                    self.error = e
+            self.pending.task_done()
+
+    def write(self, data: str):
+        if self.error is not None:
+            raise self.error
+        self.pending.put(data)
+
+    def flush(self):
+        ''' Wait until everything written so far is in the output, and flush it '''
+        self.pending.join()
+        if self.error is not None:
+            raise self.error
+        self.output.flush()
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.output.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Like Pool.imap, but reading at most max_pending items ahead from iterable
+# so that big inputs are not loaded in memory
+def imap_bounded(pool, func, iterable, max_pending: int):
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+# Approximate size in bytes of the parts shuffled in memory by shuffle_file
+SHUFFLE_CHUNK_SIZE = 256 * 1024**2
+
+# Shuffle lines from input into output in bounded memory: lines are scattered
+# at random into buckets of about chunk_size bytes, then each bucket is shuffled in memory
+def shuffle_file(input: typing.TextIO, output: typing.TextIO, chunk_size: int = SHUFFLE_CHUNK_SIZE):
+    with TemporaryFile("w+b") as temp:
+        size = 0
         for line in input:
-            offsets.append(count)
-            count += len(bytearray(line, "UTF-8"))
-            temp.write(line)
-        temp.flush()
+            if not line.endswith("\n"):
+                line += "\n"
+            size += temp.write(line.encode("utf-8"))
+        temp.seek(0)
 
-        random.shuffle(offsets)
+        num_buckets = size // chunk_size + 1
+        if num_buckets == 1:
+            buckets = [temp]
+        else:
+            buckets = [TemporaryFile("w+b") for _ in range(num_buckets)]
+        try:
+            if num_buckets > 1:
+                for line in temp:
+                    buckets[random.randrange(num_buckets)].write(line)
 
-        for offset in offsets:
-            temp.seek(offset)
-            output.write(temp.readline())
+            for bucket in buckets:
+                bucket.seek(0)
+                data = bucket.read()
+                # Offsets of every line start and the end, in a compact array instead of a list of str
+                offsets = array("Q", [0])
+                start = data.find(b"\n") + 1
+                while start:
+                    offsets.append(start)
+                    start = data.find(b"\n", start) + 1
+                order = array("Q", range(len(offsets) - 1))
+                random.shuffle(order)
+                for i in order:
+                    output.write(data[offsets[i]:offsets[i+1]].decode("utf-8"))
+                del data, offsets
+        finally:
+            for bucket in buckets:
+                bucket.close()
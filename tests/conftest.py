@@ -0,0 +1,60 @@
+from argparse import Namespace
+
+import pytest
+
+from monocleaner.lm import LMStats, LMType
+from monocleaner.monocleaner_train import write_metadata
+
+# Character model where sentences of 'a' and 'b' are fluent and anything else is not
+ARPA = """
+\\data\\
+ngram 1=6
+ngram 2=3
+
+\\1-grams:
+-3.0\t<unk>\t0
+-1.0\t<s>\t-0.2
+-1.5\t</s>\t0
+-0.3\ta\t-0.1
+-0.6\tb\t-0.3
+-0.5\t▁\t-0.1
+
+\\2-grams:
+-0.05\ta a
+-0.2\tb a
+-0.1\ta ▁
+
+\\end\\
+"""
+
+SENTENCES = [
+    "a b a a b a a a b a.",
+    "aa ab ba aab abba baab aaa.",
+    "the quick brown fox jumps over the lazy dog.",
+    "b a b b a a b a b a.",
+    "a b a a b a a a b a.",
+    "short",
+    "aab ab abba ba aab baba.",
+    "the quick brown fox jumps over the lazy dog.",
+]
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    ''' Directory of a small CHARACTER model '''
+    path = tmp_path / "model"
+    path.mkdir()
+    (path / "lm.en").write_text(ARPA)
+    args = Namespace(model_dir=str(path), language="en", lm_file_name="lm.en",
+                     lm_type=LMType.CHARACTER, tokenizer_command=None,
+                     lm_structure="probing", quantize_bits=0, load_method=None)
+    write_metadata(LMStats(-1.0, 0.2, -2.5, 0.3), args)
+    return str(path)
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    ''' Tab-separated input with the sentence in the first column and a second column '''
+    path = tmp_path / "input.tsv"
+    path.write_text("".join(f"{sentence}\t{i}\n" for i, sentence in enumerate(SENTENCES * 50)))
+    return str(path)
@@ -0,0 +1,34 @@
+from monocleaner import bench, monocleaner
+from monocleaner.lm import LMFluencyFilter, LMStats, LMType
+
+ARPA = """
+\\data\\
+ngram 1=3
+ngram 2=1
+
+\\1-grams:
+-1.0\t<unk>\t0
+-0.5\t<s>\t0
+-0.5\t</s>\t0
+
+\\2-grams:
+-0.1\t<s> </s>
+
+\\end\\
+"""
+
+
+def test_trained_model_metadata_is_loaded(tmp_path, monkeypatch):
+    # KenLM estimation is replaced by a fixed model, the metadata is written with the options of bench
+    def train(self, train_file, dev_file, dev_noisy, lm_file, *args, **kwargs):
+        with open(lm_file, "w") as lm_f:
+            lm_f.write(ARPA)
+        return LMStats(-2.0, 0.3, 1.0, 0.5)
+    monkeypatch.setattr(LMFluencyFilter, "train", train)
+    bench.train_model(bench.synthetic_corpus(100, 1), "en", str(tmp_path))
+
+    args = monocleaner.argument_parser().parse_args([str(tmp_path), "--disable_lang_ident", "-q"])
+    monocleaner.setup(args)
+    assert args.lm_type == LMType.CHARACTER
+    assert args.tokenizer_command is None
+    assert args.ff.scoring_stats.clean_mean == -2.0
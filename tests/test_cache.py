@@ -0,0 +1,26 @@
+import dbm
+import sys
+
+from monocleaner import monocleaner
+
+from conftest import SENTENCES
+
+
+def run_monocleaner(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["monocleaner", *argv, "--disable_lang_ident", "--annotated_output", "-q"])
+    monocleaner.main()
+
+
+def test_cache_file_is_stored_and_reused(model_dir, corpus, tmp_path, monkeypatch):
+    cache_file = str(tmp_path / "cache")
+    run_monocleaner(monkeypatch, model_dir, corpus, str(tmp_path / "uncached.tsv"))
+    run_monocleaner(monkeypatch, model_dir, corpus, str(tmp_path / "first.tsv"), "--cache_file", cache_file)
+
+    # Each distinct sentence is stored once and can be read back after the run
+    with dbm.open(cache_file, 'r') as cache:
+        assert len(cache.keys()) == len(set(SENTENCES))
+
+    run_monocleaner(monkeypatch, model_dir, corpus, str(tmp_path / "second.tsv"), "--cache_file", cache_file, "--cache_size", "2")
+    uncached = (tmp_path / "uncached.tsv").read_text()
+    assert (tmp_path / "first.tsv").read_text() == uncached
+    assert (tmp_path / "second.tsv").read_text() == uncached
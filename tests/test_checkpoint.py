@@ -0,0 +1,71 @@
+import gzip
+import sys
+
+import pytest
+import yaml
+
+from monocleaner import monocleaner
+from monocleaner.checkpoint import Checkpoint
+
+BLOCK_SIZE = 50
+
+
+class Interrupted(Exception):
+    pass
+
+
+def run_monocleaner(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["monocleaner", *argv, "--block_size", str(BLOCK_SIZE),
+                                      "--disable_lang_ident", "--annotated_output", "-q"])
+    monocleaner.main()
+
+
+def interrupt_after(monkeypatch, blocks):
+    ''' Write a checkpoint after each block and stop the run after blocks of them '''
+    written = []
+    def checkpoint(self, writer):
+        self.write(writer)
+        written.append(self.input_lines)
+        if len(written) == blocks:
+            raise Interrupted()
+    monkeypatch.setattr(Checkpoint, "checkpoint", checkpoint)
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_resume_gives_the_output_of_an_uninterrupted_run(model_dir, corpus, tmp_path, monkeypatch, compressed):
+    if compressed:
+        with open(corpus, "rb") as input_f, gzip.open(corpus + ".gz", "wb") as output_f:
+            output_f.write(input_f.read())
+        corpus += ".gz"
+    expected = tmp_path / "expected.tsv"
+    run_monocleaner(monkeypatch, model_dir, corpus, str(expected))
+
+    output = tmp_path / "output.tsv"
+    checkpoint = str(tmp_path / "checkpoint")
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, 3)
+        with pytest.raises(Interrupted):
+            run_monocleaner(patch, model_dir, corpus, str(output), "--checkpoint", checkpoint)
+    with open(checkpoint) as checkpoint_f:
+        state = yaml.safe_load(checkpoint_f)
+    assert state["input_lines"] == 3 * BLOCK_SIZE
+    assert (state["input_offset"] is None) == compressed
+
+    # Part of a block written after the checkpoint is scored again
+    with open(output, "a") as output_f:
+        output_f.write("partial block\t0")
+    run_monocleaner(monkeypatch, model_dir, corpus, str(output), "--checkpoint", checkpoint, "--resume")
+    assert output.read_text() == expected.read_text()
+
+
+def test_resume_of_another_run_is_rejected(model_dir, corpus, tmp_path, monkeypatch):
+    checkpoint = str(tmp_path / "checkpoint")
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, 1)
+        with pytest.raises(Interrupted):
+            run_monocleaner(patch, model_dir, corpus, str(tmp_path / "output.tsv"), "--checkpoint", checkpoint)
+
+    other = tmp_path / "other.tsv"
+    other.write_text("")
+    with pytest.raises(SystemExit):
+        run_monocleaner(monkeypatch, model_dir, corpus, str(other), "--checkpoint", checkpoint, "--resume")
@@ -0,0 +1,91 @@
+import json
+import sys
+
+import pytest
+
+from monocleaner import hardrules, monocleaner
+from monocleaner.formats import JsonlFormat, SCORE_FIELD, TAG_FIELD
+
+from conftest import SENTENCES
+
+
+def run_command(monkeypatch, module, *argv):
+    monkeypatch.setattr(sys, "argv", [module.__name__, *argv, "--disable_lang_ident", "--annotated_output", "-q"])
+    module.main()
+
+
+def test_jsonl_parse_keeps_every_line():
+    lines = ['{"text": "a b a", "id": 1}\n', 'not json\n', '["a list"]\n', '{"id": 4}\n', '{"text": 5}\n']
+    records, sentences, languages = JsonlFormat("text").parse(lines, 0)
+    assert sentences == ["a b a", None, None, None, None]
+    assert [record for _, record in records] == [{"text": "a b a", "id": 1}, None, None, {"id": 4}, {"text": 5}]
+    assert languages is None
+
+    records, sentences, languages = JsonlFormat("text", "lang").parse(['{"text": "a", "lang": " en"}\n', '{"text": "b"}\n'], 0)
+    assert sentences == ["a", None]
+    assert languages == ["en", None]
+
+
+def test_jsonl_format_appends_or_replaces_fields():
+    lines = ['{"text": "a", "id": 1}\n', 'not json\n', '{"text": "b", "monocleaner_score": 0.9, "monocleaner_tag": "old"}\n', '{}\n']
+    jsonl = JsonlFormat("text")
+    records, _, _ = jsonl.parse(lines, 0)
+    fields = [(SCORE_FIELD, [0.5, 0.0, 0.25, 0.0]), (TAG_FIELD, ["keep", "missing_columns", "keep", "missing_columns"])]
+    output = jsonl.format(records, fields).splitlines()
+    assert output[0] == '{"text": "a", "id": 1, "monocleaner_score": 0.5, "monocleaner_tag": "keep"}'
+    # Lines that are not JSON objects are replaced by the fields, so the output keeps one line per input line
+    assert json.loads(output[1]) == {SCORE_FIELD: 0.0, TAG_FIELD: "missing_columns"}
+    assert json.loads(output[2]) == {"text": "b", SCORE_FIELD: 0.25, TAG_FIELD: "keep"}
+    assert json.loads(output[3]) == {SCORE_FIELD: 0.0, TAG_FIELD: "missing_columns"}
+    assert jsonl.format(records, fields, fields_only=True).splitlines()[0] == '{"monocleaner_score": 0.5, "monocleaner_tag": "keep"}'
+
+
+def test_jsonl_records_are_scored_in_place(model_dir, tmp_path, monkeypatch):
+    input_path = tmp_path / "input.jsonl"
+    input_path.write_text("".join(json.dumps({"text": sentence}) + "\n" for sentence in SENTENCES) + "not json\n" + '{"id": 1}\n')
+    tsv_path = tmp_path / "input.tsv"
+    tsv_path.write_text("".join(sentence + "\n" for sentence in SENTENCES))
+    run_command(monkeypatch, monocleaner, model_dir, str(input_path), str(tmp_path / "output.jsonl"))
+    run_command(monkeypatch, monocleaner, model_dir, str(tsv_path), str(tmp_path / "output.tsv"))
+
+    records = [json.loads(line) for line in (tmp_path / "output.jsonl").read_text().splitlines()]
+    expected = [line.split("\t") for line in (tmp_path / "output.tsv").read_text().splitlines()]
+    assert len(records) == len(SENTENCES) + 2
+    assert [(record["text"], record[SCORE_FIELD], record[TAG_FIELD]) for record in records[:-2]] \
+        == [(sentence, float(score), tag) for sentence, score, tag in expected]
+    assert records[-2] == {SCORE_FIELD: 0.0, TAG_FIELD: "missing_columns"}
+    assert records[-1] == {"id": 1, SCORE_FIELD: 0.0, TAG_FIELD: "missing_columns"}
+
+
+def test_parquet_records_are_scored_in_place(model_dir, tmp_path, monkeypatch):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    texts = SENTENCES + [None]
+    pyarrow.parquet.write_table(pa.table({"id": list(range(len(texts))), "text": texts}), tmp_path / "input.parquet")
+    run_command(monkeypatch, monocleaner, model_dir, str(tmp_path / "input.parquet"), str(tmp_path / "scored.parquet"), "--block_size", "3")
+    run_command(monkeypatch, hardrules, "en", str(tmp_path / "input.parquet"), str(tmp_path / "tagged.parquet"))
+
+    scored = pyarrow.parquet.read_table(tmp_path / "scored.parquet")
+    tagged = pyarrow.parquet.read_table(tmp_path / "tagged.parquet")
+    for table in (scored, tagged):
+        assert table.column("id").to_pylist() == list(range(len(texts)))
+        assert table.schema.field(SCORE_FIELD).type == pa.float64()
+        assert table.column(TAG_FIELD).to_pylist()[-1] == "missing_columns"
+        assert table.column(SCORE_FIELD).to_pylist()[-1] == 0.0
+    # Both commands write the same schema, so their tables can be concatenated
+    assert pa.concat_tables([scored, tagged]).num_rows == 2 * len(texts)
+
+
+def test_empty_parquet_input_gives_a_valid_file(model_dir, tmp_path, monkeypatch):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    schema = pa.schema([("id", pa.int64()), ("text", pa.string())])
+    pyarrow.parquet.write_table(schema.empty_table(), tmp_path / "input.parquet")
+    run_command(monkeypatch, monocleaner, model_dir, str(tmp_path / "input.parquet"), str(tmp_path / "scored.parquet"))
+    run_command(monkeypatch, hardrules, "en", str(tmp_path / "input.parquet"), str(tmp_path / "tagged.parquet"))
+
+    for name in ("scored.parquet", "tagged.parquet"):
+        table = pyarrow.parquet.read_table(tmp_path / name)
+        assert table.num_rows == 0
+        assert table.schema.names == ["id", "text", SCORE_FIELD, TAG_FIELD]
+        assert table.schema.field(SCORE_FIELD).type == pa.float64()
@@ -0,0 +1,90 @@
+import random
+import io
+import os
+
+import kenlm
+import numpy
+
+from monocleaner.lm import LMFluencyFilter, LMStats, LMType, shuffle_lm_training
+
+ARPA = """
+\\data\\
+ngram 1=5
+ngram 2=2
+
+\\1-grams:
+-3.0\t<unk>\t0
+-1.0\t<s>\t-0.2
+-1.5\t</s>\t0
+-0.3\ta\t-0.1
+-2.7\tb\t-0.3
+
+\\2-grams:
+-0.05\ta a
+-0.4\tb a
+
+\\end\\
+"""
+
+
+def test_perplexity_to_score_batch_matches_scalar():
+    perps = numpy.linspace(-3.0, 3.0, 121)
+    # Regular stats and degenerate ones, with the lower limit above the upper limit
+    for stats in (LMStats(-2.0, 0.3, 1.0, 0.5), LMStats(-1.0, 0.1, 0.0, 0.1)):
+        expected = [stats.perplexity_to_score(perp) for perp in perps]
+        assert stats.perplexity_to_score_batch(perps).tolist() == expected
+
+
+def test_bounded_score_is_the_score_or_certain_to_be_below_floor(tmp_path):
+    (tmp_path / "lm.arpa").write_text(ARPA)
+    ff = LMFluencyFilter(LMType.CHARACTER, "en", None)
+    ff.lm = kenlm.Model(str(tmp_path / "lm.arpa"))
+    random.seed(1)
+    exits = 0
+    for _ in range(500):
+        noise = random.random()
+        words = ["b" if random.random() < noise else "a" for _ in range(random.randint(64, 300))]
+        sentence = " ".join(words)
+        length = len(words) + 1
+        floor = random.uniform(-2.0, -0.2)
+        score = ff._bounded_score(sentence, length, floor)
+        if score == float("-inf"):
+            exits += 1
+            assert ff.lm.score(sentence) / length < floor
+        else:
+            assert score == ff.lm.score(sentence)
+    assert 0 < exits < 500
+
+
+def test_early_exit_does_not_change_scores(tmp_path):
+    (tmp_path / "lm.arpa").write_text(ARPA)
+    random.seed(2)
+    sentences = []
+    for _ in range(300):
+        noise = random.random()
+        sentences.append(" ".join("b" if random.random() < noise else "a" for _ in range(random.randint(40, 200))))
+    ff = LMFluencyFilter(LMType.CHARACTER, "en", None)
+    ff.load(str(tmp_path / "lm.arpa"))
+    perps = ff.raw_score_batch(sentences)
+    low, high = numpy.percentile(perps, [30, 70])
+
+    # Regular stats and degenerate ones, where perplexities between the two limits get 1
+    for stats in (LMStats(high, 0.1, low, 0.1), LMStats(low - 0.1, 0.1, high + 0.1, 0.1)):
+        ff.scoring_stats = stats
+        ff.early_exit = False
+        expected = ff.score_batch(sentences)
+        ff.early_exit = True
+        assert ff.score_batch(sentences).tolist() == expected.tolist()
+
+
+def test_shuffle_lm_training_splits_every_line(tmp_path):
+    lines = [f"sentence {i}\n" for i in range(1000)]
+    train_file, dev_file = shuffle_lm_training(io.StringIO("".join(lines)), 100)
+    try:
+        with open(train_file) as train_f, open(dev_file) as dev_f:
+            train, dev = train_f.readlines(), dev_f.readlines()
+    finally:
+        os.remove(train_file)
+        os.remove(dev_file)
+    assert len(dev) == 100
+    assert sorted(train + dev) == sorted(lines)
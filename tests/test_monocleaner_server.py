@@ -0,0 +1,42 @@
+import subprocess
+import time
+import sys
+import os
+
+import pytest
+
+from monocleaner import monocleaner, monocleaner_server
+
+
+@pytest.mark.parametrize("option", [["--cache_size", "100"], ["--cache_file", "cache"]])
+def test_cache_options_are_rejected(model_dir, tmp_path, monkeypatch, option):
+    monkeypatch.setattr(sys, "argv", ["monocleaner-server", "--socket", str(tmp_path / "socket"), "-p", "1", model_dir, *option])
+    with pytest.raises(SystemExit):
+        monocleaner_server.initialization()
+
+
+def test_clients_get_the_monocleaner_output(model_dir, corpus, tmp_path, monkeypatch):
+    options = ["--disable_lang_ident", "--annotated_output", "--block_size", "50", "-q"]
+    monkeypatch.setattr(sys, "argv", ["monocleaner", model_dir, corpus, str(tmp_path / "expected.tsv"), *options])
+    monocleaner.main()
+
+    socket_path = str(tmp_path / "socket")
+    server = subprocess.Popen([sys.executable, "-m", "monocleaner.monocleaner_server", "--socket", socket_path,
+                               "-p", "2", model_dir, *options])
+    try:
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.1)
+        # Two clients at the same time
+        clients = [subprocess.Popen([sys.executable, "-m", "monocleaner.monocleaner_client", "--socket", socket_path,
+                                     corpus, str(tmp_path / f"output{i}.tsv")]) for i in range(2)]
+        assert [client.wait(timeout=60) for client in clients] == [0, 0]
+    finally:
+        server.terminate()
+        assert server.wait(timeout=60) == 0
+    assert not os.path.exists(socket_path)
+
+    expected = (tmp_path / "expected.tsv").read_text()
+    for i in range(2):
+        assert (tmp_path / f"output{i}.tsv").read_text() == expected
@@ -0,0 +1,35 @@
+from argparse import Namespace
+
+from monocleaner.lm import LMStats, LMType
+from monocleaner.monocleaner_train import write_metadata
+from monocleaner import monocleaner
+
+ARPA = """
+\\data\\
+ngram 1=3
+ngram 2=1
+
+\\1-grams:
+-1.0\t<unk>\t0
+-0.5\t<s>\t0
+-0.5\t</s>\t0
+
+\\2-grams:
+-0.1\t<s> </s>
+
+\\end\\
+"""
+
+
+def test_placeholder_model_round_trips_through_metadata(tmp_path):
+    (tmp_path / "lm.en").write_text(ARPA)
+    train_args = Namespace(model_dir=str(tmp_path), language="en", lm_file_name="lm.en",
+                           lm_type=LMType.PLACEHOLDER, tokenizer_command="tokenizer.sh -l en: -x",
+                           lm_structure="probing", quantize_bits=0, load_method=None)
+    write_metadata(LMStats(-2.0, 0.3, 1.0, 0.5), train_args)
+
+    args = monocleaner.argument_parser().parse_args([str(tmp_path), "--disable_lang_ident", "-q"])
+    monocleaner.setup(args)
+    assert args.lm_type == LMType.PLACEHOLDER
+    assert args.ff.type == LMType.PLACEHOLDER
+    assert args.tokenizer_command == "tokenizer.sh -l en: -x"
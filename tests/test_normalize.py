@@ -0,0 +1,37 @@
+from itertools import product
+import random
+
+import pytest
+
+from monocleaner.normalize import MosesPunctNormalizer
+
+SENTENCES = [
+    "The \"quick\" brown fox (jumps) over the lazy dog .",
+    "Il a dit : « bonjour » ; puis il est parti !",
+    "Das kostet 1 234,50 € , oder 12 % mehr.",
+    "``Penn'' style quotes and `single' ones.",
+    "He said \"yes\", then \"no\".",
+    "Numbers 1 000 000 and 3 . 14 and 1,5 .",
+    "Ellipsis... and dashes – and — and „quotes“ ‚here‘.",
+    "中文，句子。日本語、文章！（括弧）：「引用」",
+    "Tabs\tand non breaking spaces\r\n",
+    "",
+]
+
+# Characters the substitutions look for, random strings of them hit their corner cases
+ALPHABET = "  \r`'\"()[].,:;!?%-0123456789aAbzºCcmn„“”–—´‘‚’…«»<\t，。、“”：？《》）！（\x07​"
+
+
+def random_strings(count, seed):
+    rand = random.Random(seed)
+    return ["".join(rand.choice(ALPHABET) for _ in range(rand.randint(0, 20))) for _ in range(count)]
+
+
+@pytest.mark.parametrize("lang", ["en", "es", "fr", "de", "cs", "fi"])
+def test_normalize_matches_the_reference_chain(lang):
+    lines = SENTENCES + random_strings(300, 0)
+    for penn, quote_commas, numbers, pre_unicode, post_control in product((True, False), repeat=5):
+        normalizer = MosesPunctNormalizer(lang=lang, penn=penn, norm_quote_commas=quote_commas, norm_numbers=numbers,
+                                          pre_replace_unicode_punct=pre_unicode, post_remove_control_chars=post_control)
+        for line in lines:
+            assert normalizer.normalize(line) == normalizer.normalize_reference(line), (penn, quote_commas, numbers, pre_unicode, post_control, line)
@@ -0,0 +1,84 @@
+from argparse import Namespace
+import random
+
+import pytest
+import regex
+
+from monocleaner import repeats
+from monocleaner.hardrules import Hardrules
+from monocleaner.repeats import regex_repeated_words, regex_repeated_without_words, repeated_words, repeated_substrings
+
+SENTENCES = [
+    "",
+    "a",
+    "The cat sat on the mat and the cat sat on the mat again.",
+    "THE CAT SAT ON the cat sat on the floor.",
+    "the quick brown fox jumps over the lazy dog",
+    "Home > News > Home > News > Sports",
+    "word word word word word word",
+    "abcabcabcabc",
+    "123412341234 12341234",
+    "hahahahahahahaha that was funny",
+    "ξένος ΞΈΝΟΣ ξένος ΞΈΝΟΣ ξένος",
+    "İstanbul istanbul İSTANBUL ıstanbul Istanbul",
+    "kısa kIsa KISA kısa kısa kısa",
+    "first line first line\nfirst line first line",
+    "straße STRASSE straße STRASSE",
+    "这是一个句子这是一个句子",
+    "東京都東京都東京都",
+    "ab  ab  ab  ab  ab  ab",
+    "Ǆemal ǅemal ǆemal Ǆemal ǅemal ǆemal",
+]
+
+WORDS = ["the", "The", "THE", "cat", "Cat", "sat", "is", "IS", "σοφία", "ΣΟΦΊΑ", "12", "-", ">", "ab", "aba"]
+
+
+def reference(pattern, sentence, min_chars):
+    ''' Decision of the no_repeated_words hardrule with the regex '''
+    for match in pattern.finditer(sentence):
+        matching = match.group().strip()
+        if len(matching) > min_chars and regex.search("[[:alpha:]]", matching):
+            return True
+    return False
+
+
+def random_sentences(count, seed):
+    rng = random.Random(seed)
+    sentences = []
+    for _ in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(1, 12))]
+        if rng.random() < 0.1:
+            # Sentences with these are checked with the regex by repeated_words
+            words.insert(rng.randrange(len(words) + 1), rng.choice(["İs", "ıs"]))
+        if rng.random() < 0.5:
+            # Repeat a span of the sentence, with the case of some of its words changed
+            start = rng.randrange(len(words))
+            span = words[start:start + rng.randint(1, 4)]
+            words += [w.upper() if rng.random() < 0.3 else w for w in span]
+        separators = [rng.choice([" ", " ", " ", "  ", "", "\n"]) for _ in words]
+        sentences.append("".join(w + s for w, s in zip(words, separators)).strip())
+    return sentences
+
+
+@pytest.mark.parametrize("min_chars", [7, 4])
+@pytest.mark.parametrize("sentence", SENTENCES + random_sentences(300, 1))
+def test_repeated_words_match_the_regex(sentence, min_chars):
+    assert repeated_words(sentence, min_chars) == reference(regex_repeated_words, sentence, min_chars)
+
+
+@pytest.mark.parametrize("min_chars", [7, 4])
+@pytest.mark.parametrize("sentence", SENTENCES + random_sentences(300, 2))
+def test_repeated_substrings_match_the_regex(sentence, min_chars):
+    assert repeated_substrings(sentence, min_chars) == reference(regex_repeated_without_words, sentence, min_chars)
+
+
+def test_rule_out_of_candidates_is_tagged_timeout(monkeypatch):
+    args = Namespace(language="en", disable_minimal_length=False, fastspell=None, detect_script=False,
+                     disable_lang_ident=True, rules_timeout=0, rules_warmup=0, rules_profile=None,
+                     disable_hardrules=False, run_all_rules=False, annotated_output=True)
+    sentence = "The cat sat on the mat the cat sat on the mat."
+    hardrules = Hardrules(args)
+    assert hardrules.wrong_segment(args, sentence) == "no_repeated_words"
+
+    monkeypatch.setattr(repeats, "MAX_CANDIDATES_PER_CHAR", 0)
+    assert hardrules.wrong_segment(args, sentence) == "no_repeated_words_timeout"
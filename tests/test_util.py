@@ -0,0 +1,18 @@
+import io
+import random
+
+import pytest
+
+from monocleaner.util import shuffle_file
+
+
+@pytest.mark.parametrize("chunk_size", [64, 1000, 2**20])
+def test_shuffle_file_is_a_permutation(chunk_size):
+    random.seed(3)
+    lines = [f"línea {i} " + "x" * random.randint(0, 30) + "\n" for i in range(500)]
+    # The last line has no newline, it gets one
+    output = io.StringIO()
+    shuffle_file(io.StringIO("".join(lines).rstrip("\n")), output, chunk_size=chunk_size)
+    shuffled = output.getvalue().splitlines(keepends=True)
+    assert sorted(shuffled) == sorted(lines)
+    assert shuffled != lines